@@ -1,12 +1,18 @@
+import base64
 import hashlib
+import json
 import random
-from typing import List
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import lru_cache
+from typing import List, Tuple, Dict
 import logging
 
 import numpy as np
 import requests
 from geopy.distance import geodesic
-from scipy.special import lambertw
 
 from client_display_map import create_map_html
 
@@ -14,48 +20,115 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 SERVER_URL = "http://localhost:8000"
+RADIUS_TABLE_SIZE = 4096
+LOCATION_RESEND_INTERVAL_SECONDS = 60  # same location (grid cell): no update sent within this interval
 
 
-def _get_access_token(user_id, password: str = "secret"):
-    url = f"{SERVER_URL}/login_for_access_token"
-    headers = {
-        "accept": "application/json",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    data = {
-        "username": user_id,
-        "password": password
-    }
-    response = requests.post(url, headers=headers, data=data)
+class _Tokens:
+    """access token of a user. renewed with the refresh token shortly before it expires (no bcrypt on the server),
+    login again only if the refresh token is rejected"""
 
-    if not response.ok:
-        print(response.json())
-        raise ValueError("Error getting access token")
+    def __init__(self, user_id, password: str = "secret", server_url: str = SERVER_URL, renew_before_seconds=30):
+        self.user_id = user_id
+        self.password = password
+        self.server_url = server_url
+        self.renew_before_seconds = renew_before_seconds
+        self._access_token = None
+        self._refresh_token = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._login()
 
-    token = response.json()["access_token"]
-    log.info(f"user '{user_id}' generated access token")
-    return token
+    @staticmethod
+    def _expiry(token: str) -> float:
+        """exp claim (not verified, the server does that)"""
+        payload = token.split(".")[1]
+        return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"]
+
+    def _set(self, response):
+        body = response.json()
+        self._access_token = body["access_token"]
+        self._refresh_token = body.get("refresh_token") or self._refresh_token
+        self._expires = self._expiry(self._access_token)
+
+    def _login(self):
+        headers = {
+            "accept": "application/json",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
+        data = {
+            "username": self.user_id,
+            "password": self.password
+        }
+        response = requests.post(f"{self.server_url}/login_for_access_token", headers=headers, data=data)
+
+        if not response.ok:
+            print(response.json())
+            raise ValueError("Error getting access token")
+
+        self._set(response)
+        log.info(f"user '{self.user_id}' generated access token")
+
+    def _refresh(self):
+        if self._refresh_token:
+            response = requests.post(f"{self.server_url}/refresh_access_token",
+                                     json={"refresh_token": self._refresh_token})
+            if response.ok:
+                self._set(response)
+                log.info(f"user '{self.user_id}' refreshed access token")
+                return
+            log.info(f"refresh token rejected ({response.status_code}), login again")
+        self._login()
+
+    @property
+    def access_token(self) -> str:
+        with self._lock:
+            if time.time() > self._expires - self.renew_before_seconds:
+                self._refresh()
+            return self._access_token
 
 
 class LocationClient:
-    def __init__(self, server_url=SERVER_URL, user_id=None, epsilon=1.1):
+    def __init__(self, server_url=SERVER_URL, user_id=None, epsilon=1.1,
+                 resend_interval_seconds: float = LOCATION_RESEND_INTERVAL_SECONDS):
+        """resend_interval_seconds: an unchanged location (same grid cell) reuses the last noisy point
+        and is not sent again within this interval (0: always send)"""
         self.server_url = server_url
         self.user_id = user_id
         self.epsilon = epsilon
         self.mechanism = Noise(epsilon=epsilon, rmax=3)
-        self.access_token = _get_access_token(user_id)
-        self.headers = {"Content-Type": "application/json",
-                        "accept": "application/json",
-                        "Authorization": f"Bearer {self.access_token}"
-                        }
+        self.resend_interval_seconds = resend_interval_seconds
+        self._last_sent = None  # (grid cell of true location, noisy point, time sent)
+        self._nearby_cache = {}  # request params -> (etag, nearby users)
+        self._tokens = _Tokens(user_id, server_url=server_url)
+
+    @property
+    def access_token(self) -> str:
+        return self._tokens.access_token
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Content-Type": "application/json",
+                "accept": "application/json",
+                "Authorization": f"Bearer {self.access_token}"
+                }
 
     def update_location(self, latitude: float, longitude: float):
         """send location update to server. adds noise to location before sending"""
         log.info(f"update location for user '{self.user_id}'")
         endpoint = f"{self.server_url}/locations"
 
-        # add noise
-        noisy_latitude, noisy_longitude = self._add_noise(latitude, longitude)
+        # same location as last sent: same noisy point (fresh noise per resend would average out),
+        # which the server recognizes as a no-op. not sent at all within resend_interval_seconds
+        cell = (round(latitude / self.mechanism.grid_unit), round(longitude / self.mechanism.grid_unit))
+        if self._last_sent and self._last_sent[0] == cell:
+            noisy_latitude, noisy_longitude = self._last_sent[1]
+            if time.time() - self._last_sent[2] < self.resend_interval_seconds:
+                log.info(f"location unchanged, update suppressed")
+                return {"status": "unchanged", "latitude": noisy_latitude, "longitude": noisy_longitude}
+        else:
+            # add noise
+            noisy_latitude, noisy_longitude = self._add_noise(latitude, longitude)
 
         # print distance
         print(f"noisy location: {noisy_latitude:.4f}, {noisy_longitude:.4f}, " +
@@ -72,6 +145,7 @@ class LocationClient:
             if not response.ok:
                 print(f"response: {response.json()}")
             response.raise_for_status()
+            self._last_sent = (cell, (noisy_latitude, noisy_longitude), time.time())
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Error updating location: {e}")
@@ -81,22 +155,48 @@ class LocationClient:
         log.info(f"add noise to location")
         return self.mechanism.add_noise(latitude, longitude)
 
-    def get_nearby_users(self, max_distance_km: float = 5.0):
-        """get users within specified distance (km)"""
+    def get_nearby_users(self, max_distance_km: float = 5.0, adaptive: bool = False, precision: str = "exact"):
+        """get users within specified distance (km).
+        adaptive: server picks a smaller radius in dense areas (max_distance_km is the upper bound)
+        precision: exact | fast | sphere (cheaper ranking, distances off by < 0.6%)"""
         log.info(f"get nearby users for user '{self.user_id}'")
         endpoint = f"{self.server_url}/locations/nearby_users/?user_id={self.user_id}"
-        params = {"max_distance": max_distance_km}
+        params = {"max_distance": max_distance_km, "adaptive": adaptive, "precision": precision}
+        # conditional request: 304 if unchanged since the cached result
+        key = (max_distance_km, adaptive, precision)
+        cached = self._nearby_cache.get(key)
+        headers = {**self.headers, "If-None-Match": cached[0]} if cached else self.headers
         try:
-            response = requests.get(endpoint, params=params, headers=self.headers)
+            response = requests.get(endpoint, params=params, headers=headers)
+            if response.status_code == 304:
+                log.info(f"nearby users unchanged")
+                return cached[1]
             if not response.ok:
                 print(f"response: {response.json()}")
             response.raise_for_status()
-            return response.json()
+            nearby_users = response.json()
+            if response.headers.get("ETag"):
+                self._nearby_cache[key] = (response.headers["ETag"], nearby_users)
+            else:
+                self._nearby_cache.pop(key, None)
+            return nearby_users
         except requests.exceptions.RequestException as e:
             print(f"Error getting nearby users: {e}")
             return None
 
 
+@lru_cache(maxsize=32)
+def _radius_inverse_cdf(epsilon: float, rmax: float, size: int = RADIUS_TABLE_SIZE):
+    """(cdf, radius) table of the truncated noise radius, shared by all Noise instances.
+    planar laplace radius cdf: C(r) = 1 - (1 + εr)e^(-εr). radii beyond rmax are mapped
+    uniformly to [0.7, 1] * rmax (see Noise.add_noise_reference), adding (1 - C(rmax)) spread over that band"""
+    radius = np.linspace(0, rmax, size)
+    cdf = 1 - (1 + epsilon * radius) * np.exp(-epsilon * radius)
+    tail = 1 - cdf[-1]
+    cdf = cdf + tail * np.clip((radius - 0.7 * rmax) / (0.3 * rmax), 0, 1)
+    return cdf, radius
+
+
 class Noise:
     def __init__(self, epsilon=1.0, grid_unit=0.0005, rmax=3):
         """
@@ -107,12 +207,39 @@ class Noise:
         self.rmax = rmax
 
     def _sample_polar(self):
+        """untruncated radius, exact inverse cdf (lambert w)"""
+        from scipy.special import lambertw  # slow import, only needed for the reference sampler
+
         theta = np.random.uniform(0, 2 * np.pi)  # random angle in [0, 2π]
         p = np.random.uniform(0, 1)
         radius = -1 / self.epsilon * (lambertw((p - 1) / np.e, k=-1).real + 1)
         return radius, theta
 
+    def _sample_polar_truncated(self):
+        """radius already truncated to rmax, from the interpolated inverse cdf table"""
+        theta = np.random.uniform(0, 2 * np.pi)  # random angle in [0, 2π]
+        cdf, radii = _radius_inverse_cdf(float(self.epsilon), float(self.rmax))
+        radius = float(np.interp(np.random.uniform(0, 1), cdf, radii))
+        return radius, theta
+
     def add_noise(self, x, y):
+        radius, theta = self._sample_polar_truncated()
+
+        noise_x = radius * np.cos(theta) / 111.32
+        noise_y = radius * np.sin(theta) / (111.32 * np.cos(np.radians(x)))
+
+        # add noise to original coordinates
+        noisy_x = x + noise_x
+        noisy_y = y + noise_y
+
+        # discretize to grid
+        noisy_x = round(noisy_x / self.grid_unit) * self.grid_unit
+        noisy_y = round(noisy_y / self.grid_unit) * self.grid_unit
+
+        return noisy_x, noisy_y
+
+    def add_noise_reference(self, x, y):
+        """previous sampler (lambert w + geodesic truncation), to validate add_noise against"""
         radius, theta = self._sample_polar()
 
         noise_x = radius * np.cos(theta) / 111.32
@@ -166,6 +293,25 @@ class Util:
         plt.legend()
         plt.show()
 
+    @staticmethod
+    def validate_noise_sampler(n=20_000, epsilon=1.1, rmax=3):
+        """two-sample ks test: distances of add_noise vs add_noise_reference"""
+        from scipy.stats import ks_2samp
+        mechanism = Noise(epsilon=epsilon, rmax=rmax)
+        big_ben_coords = (51.5007, -0.1246)
+
+        samples = {}
+        for name, add_noise in [("table", mechanism.add_noise), ("reference", mechanism.add_noise_reference)]:
+            t = time.perf_counter()
+            points = [add_noise(*big_ben_coords) for _ in range(n)]
+            elapsed = time.perf_counter() - t
+            samples[name] = [geodesic(big_ben_coords, point).kilometers for point in points]
+            print(f"{name}: {elapsed / n * 1e6:.1f} us/sample, mean distance {np.mean(samples[name]):.3f} km")
+
+        result = ks_2samp(samples["table"], samples["reference"])
+        print(f"ks statistic {result.statistic:.4f}, p-value {result.pvalue:.3f}")
+        return result
+
     @staticmethod
     def distribution_example(n=1000, epsilon=1.1, rmax=3):
         mechanism = Noise(epsilon=epsilon, rmax=rmax)
@@ -206,67 +352,230 @@ p = int(
     'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9'
     'DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
     '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+P_BYTES = (p.bit_length() + 7) // 8
+
+# joiner sends H(x)^ab as truncated digests instead of full values (None: full values).
+# false positive probability per session ~ len(x) * len(y) / 2^bits
+PSI_DIGEST_BITS = 64
+
+
+# blinding factor reuse across sessions: new factor every n seconds (None: one factor per client)
+PSI_KEY_ROTATION_SECONDS = None
+PSI_BLIND_CACHE_SIZE = 10_000  # cached H(item)^a values (LRU)
+# payloads from this size are sent as resumable chunked uploads instead of one json body
+PSI_CHUNKED_UPLOAD_MIN_BYTES = 256 * 1024
+PSI_CHUNK_BYTES = 1024 * 1024
+PSI_UPLOAD_RETRIES = 5
+PSI_WAIT_POLL_SECONDS = 25  # server side long poll per request
+
+
+def _digest(value: int, n_bytes: int) -> bytes:
+    return hashlib.sha256(value.to_bytes(P_BYTES, 'big')).digest()[:n_bytes]
+
+
+def _pack_values(values: List[int]) -> bytes:
+    return b"".join(v.to_bytes(P_BYTES, 'big') for v in values)
+
+
+def _decode_values(b64: str) -> List[int]:
+    """values from server as base64 of fixed width big endian buffer (GET /psi/{id}?encoding=b64)"""
+    buf = memoryview(base64.b64decode(b64))
+    return [int.from_bytes(buf[i:i + P_BYTES], 'big') for i in range(0, len(buf), P_BYTES)]
 
 
 class PSIClient:
-    def __init__(self, user_id, server_url: str = "http://localhost:8000"):
+    def __init__(self, user_id, server_url: str = "http://localhost:8000",
+                 key_rotation_seconds: float | None = PSI_KEY_ROTATION_SECONDS,
+                 cache_size: int = PSI_BLIND_CACHE_SIZE):
+        """blinding factor and H(item)^a values are reused across sessions within a key epoch
+        (key_rotation_seconds), cached H(item)^a values are evicted LRU beyond cache_size"""
         self.server_url = server_url
-        self.blinding_factor = random.randint(1, (p - 1) // 2 - 1)
+        self.key_rotation_seconds = key_rotation_seconds
+        self.cache_size = cache_size
+        self._epoch = None
+        self._blinding_factor = None
+        self._blind_cache: OrderedDict[Tuple[int, str], int] = OrderedDict()  # (epoch, item) -> H(item)^a
+        self._lock = threading.Lock()
+        self._pool = None
         self.items = []
         self.user_id = user_id
-        self.access_token = _get_access_token(user_id)
-        self.headers = {"Content-Type": "application/json",
-                        "accept": "application/json",
-                        "Authorization": f"Bearer {self.access_token}"
-                        }
+        self._tokens = _Tokens(user_id, server_url=server_url)
+
+    @property
+    def access_token(self) -> str:
+        return self._tokens.access_token
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Content-Type": "application/json",
+                "accept": "application/json",
+                "Authorization": f"Bearer {self.access_token}"
+                }
+
+    def _current_key(self) -> Tuple[int, int]:
+        """(epoch, blinding factor). a new factor is drawn when the epoch changes"""
+        epoch = int(time.time() // self.key_rotation_seconds) if self.key_rotation_seconds else 0
+        with self._lock:
+            if epoch != self._epoch:
+                self._epoch = epoch
+                self._blinding_factor = random.randint(1, (p - 1) // 2 - 1)
+                self._blind_cache.clear()  # values of old epoch are useless
+            return self._epoch, self._blinding_factor
+
+    @property
+    def blinding_factor(self) -> int:
+        return self._current_key()[1]
+
+    def _hash_and_blind(self, item: str, key: Tuple[int, int] | None = None) -> int:
+        epoch, blinding_factor = key or self._current_key()
+        with self._lock:
+            value = self._blind_cache.get((epoch, item))
+            if value is not None:
+                self._blind_cache.move_to_end((epoch, item))
+                return value
 
-    def _hash_and_blind(self, item: str) -> int:
         h = hashlib.sha256(item.encode()).digest()
         hi = int.from_bytes(h, 'big')
-        return pow(hi, self.blinding_factor, p)
-
-    def _blind(self, value: int) -> int:
-        return pow(value, self.blinding_factor, p)
+        value = pow(hi, blinding_factor, p)
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._blind_cache[(epoch, item)] = value
+                if len(self._blind_cache) > self.cache_size:
+                    self._blind_cache.popitem(last=False)
+        return value
+
+    def _blind(self, value: int, blinding_factor: int | None = None) -> int:
+        return pow(value, blinding_factor or self.blinding_factor, p)
+
+    def _upload(self, payload: bytes, **params) -> requests.Response:
+        """chunked upload (server /psi/uploads), resumes from the server's offset after a dropped connection.
+        returns the seal response"""
+        url = f"{self.server_url}/psi/uploads"
+        response = requests.post(url, headers=self.headers, json={"size": len(payload), **params})
+        if not response.ok:
+            print(response.json())
+            raise ValueError("Error opening PSI upload")
+        upload_id = response.json()["upload_id"]
+
+        headers = {**self.headers, "Content-Type": "application/octet-stream"}
+        offset, attempts = 0, 0
+        while True:
+            try:
+                if offset is None:  # resume: ask server how much it has
+                    response = requests.get(f"{url}/{upload_id}", headers=self.headers, timeout=30)
+                    response.raise_for_status()
+                    offset = response.json()["offset"]
+                if offset >= len(payload):
+                    break
+                response = requests.patch(f"{url}/{upload_id}", headers=headers, params={"offset": offset},
+                                          data=payload[offset:offset + PSI_CHUNK_BYTES], timeout=60)
+                response.raise_for_status()
+                offset = response.json()["offset"]
+            except requests.exceptions.RequestException as e:
+                attempts += 1
+                if attempts > PSI_UPLOAD_RETRIES:
+                    raise ValueError(f"Error uploading PSI values: {e}")
+                log.info(f"upload {upload_id} interrupted ({e}), resume (attempt {attempts})")
+                time.sleep(0.5 * attempts)
+                offset = None
+
+        log.info(f"uploaded {len(payload)} bytes ({upload_id})")
+        return requests.post(f"{url}/{upload_id}/seal", headers=self.headers)
+
+    def wait_for(self, session_id: str, until: str, timeout_seconds: float = 300) -> dict:
+        """block until the session is joined (until="joined") or this user's intersection count is set
+        (until="intersection"), with long polls: one request per PSI_WAIT_POLL_SECONDS instead of tight polling.
+        returns the last server response ({"status", "ready", ...}), ready false on timeout"""
+        deadline = time.monotonic() + timeout_seconds
+        with requests.Session() as requests_session:
+            while True:
+                poll = min(PSI_WAIT_POLL_SECONDS, max(deadline - time.monotonic(), 0.1))
+                try:
+                    response = requests_session.get(f"{self.server_url}/psi/{session_id}/wait", headers=self.headers,
+                                                    params={"until": until, "timeout": poll}, timeout=poll + 10)
+                except requests.exceptions.RequestException as e:
+                    log.info(f"wait for {until} of {session_id} interrupted ({e})")
+                    if time.monotonic() >= deadline:
+                        raise ValueError(f"Error waiting for PSI session: {e}")
+                    time.sleep(1)
+                    continue
+                if not response.ok:
+                    print(response.json())
+                    raise ValueError("Error waiting for PSI session")
+                result = response.json()
+                if result["ready"] or time.monotonic() >= deadline:
+                    return result
+
+    def warm(self, items: List[str]) -> Future:
+        """precompute H(item)^a for items in the background (e.g. user's known interests),
+        so later initiate/join for these items only do network calls"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="psi-warm")
+        key = self._current_key()
+        return self._pool.submit(lambda: [self._hash_and_blind(x, key) for x in items])
 
 
 class InitiatorClient(PSIClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session_factors: Dict[str, int] = {}  # session_id -> blinding factor used in step 1
+
     def initiate(self, items: List[str]) -> str:  # step 1
         self.items = items
-        blinded_values = [self._hash_and_blind(x) for x in items]
+        key = self._current_key()
+        blinded_values = [self._hash_and_blind(x, key) for x in items]
 
-        response = requests.post(
-            f"{self.server_url}/psi/init", headers=self.headers,
-            json={"blinded_values": blinded_values, "user_id": self.user_id}
-        )
+        if len(items) * P_BYTES >= PSI_CHUNKED_UPLOAD_MIN_BYTES:
+            response = self._upload(_pack_values(blinded_values), purpose="init")
+        else:
+            response = requests.post(
+                f"{self.server_url}/psi/init", headers=self.headers,
+                json={"blinded_values": blinded_values, "user_id": self.user_id}
+            )
 
         if not response.ok:
             print(response.json())
             raise ValueError("Error initiating PSI")
 
         session_id = response.json()["session_id"]
+        self._session_factors[session_id] = key[1]  # step 3 must use same factor, even if key rotated
         log.info(f"user '{self.user_id}' initiated PSI {session_id} with {len(items)} items (step 1)")
         return session_id
 
-    def compute_intersection(self, session_id: str):
+    def compute_intersection(self, session_id: str, wait_seconds: float = 0):
+        """wait_seconds: wait (long poll) up to this long for the joiner first"""
         log.info(f"'{self.user_id}' compute intersection for session {session_id} (step 3)")
         intersections = {}
+        blinding_factor = self._session_factors.get(session_id)
+        if wait_seconds and not self.wait_for(session_id, "joined", wait_seconds)["ready"]:
+            raise ValueError(f"PSI session {session_id} not joined within {wait_seconds}s")
 
         with requests.Session() as requests_session:
-            response = requests_session.get(f"{self.server_url}/psi/{session_id}", headers=self.headers)
+            response = requests_session.get(f"{self.server_url}/psi/{session_id}", headers=self.headers,
+                                            params={"encoding": "b64"})
             if not response.ok:
                 print(response.json())
                 raise ValueError("Error computing intersection")
             if response.json()["status"] != 2:
                 raise ValueError(f"Invalid session status {response.json()["status"]} (not 2)")
 
-            response_values = response.json()["values"]
+            response_values = {user: _decode_values(v) for user, v in response.json()["values"].items()}
+            response_digests = response.json().get("digests", {})
 
             for user, user_values in response_values.items():
-                n = len(user_values) - len(self.items)
-                bob_y_values = user_values[:n]
-                bob_x_values = user_values[n:]
-
-                alice_blinded_y = [self._blind(y) for y in bob_y_values]  # H(y)^ab
+                if user in response_digests:
+                    # H(y)^b values, H(x)^ab as digests
+                    n_bytes = response_digests[user]["bits"] // 8
+                    data = base64.b64decode(response_digests[user]["data"])
+                    bob_y_values = user_values
+                    bob_x_values = [data[i:i + n_bytes] for i in range(0, len(data), n_bytes)]
+                    alice_blinded_y = {_digest(self._blind(y, blinding_factor), n_bytes) for y in bob_y_values}  # H(y)^ab
+                else:
+                    n = len(user_values) - len(self.items)
+                    bob_y_values = user_values[:n]
+                    bob_x_values = user_values[n:]
+                    alice_blinded_y = {self._blind(y, blinding_factor) for y in bob_y_values}  # H(y)^ab
 
                 # matches
                 intersection = []
@@ -291,42 +600,49 @@ class InitiatorClient(PSIClient):
 
 
 class JoinerClient(PSIClient):
-    def join(self, session_id: str, items: List[str]) -> None:  # step 2
-        """ process initiator's values and sending response."""
+    def join(self, session_id: str, items: List[str], digest_bits: int | None = PSI_DIGEST_BITS) -> None:  # step 2
+        """ process initiator's values and sending response.
+        digest_bits: send H(x)^ab as truncated digests of this size (None: full values)"""
         self.items = items
         log.info(f"user '{self.user_id}' join PSI {session_id} with {len(items)} items (step 2)")
 
         # get initiator's blinded values
-        response = requests.get(f"{self.server_url}/psi/{session_id}", headers=self.headers)
+        response = requests.get(f"{self.server_url}/psi/{session_id}", headers=self.headers,
+                                params={"encoding": "b64"})
         if not response.ok:
             print(response.json())
             raise ValueError("Error joining PSI")
 
-        alice_values = response.json()["values"]
+        alice_values = _decode_values(response.json()["values"])
 
         # H(y)^b for self items
-        blinded_y = [self._hash_and_blind(y) for y in items]
+        key = self._current_key()
+        blinded_y = [self._hash_and_blind(y, key) for y in items]
 
         # H(x)^ab for initiator's items
-        double_blinded_x = [self._blind(x) for x in alice_values]
+        double_blinded_x = [self._blind(x, key[1]) for x in alice_values]
 
         # response
-        response_values = blinded_y + double_blinded_x
-        res = requests.post(
-            f"{self.server_url}/psi/{session_id}/join",
-            headers=self.headers,
-            json={
-                "session_id": session_id,
-                "response_values": response_values,
-                "user_id": self.user_id
-            }
-        )
+        response_values = blinded_y if digest_bits else blinded_y + double_blinded_x
+        digests = b"".join(_digest(x, digest_bits // 8) for x in double_blinded_x) if digest_bits else b""
+
+        if len(response_values) * P_BYTES + len(digests) >= PSI_CHUNKED_UPLOAD_MIN_BYTES:
+            res = self._upload(_pack_values(response_values) + digests,
+                               purpose="join", session_id=session_id, digest_bits=digest_bits or None)
+        else:
+            data = {"session_id": session_id, "user_id": self.user_id, "response_values": response_values}
+            if digest_bits:
+                data.update({"digest_bits": digest_bits, "response_digests": base64.b64encode(digests).decode()})
+            res = requests.post(f"{self.server_url}/psi/{session_id}/join", headers=self.headers, json=data)
 
         if not res.ok:
             print(res.json())
             raise ValueError("Error joining PSI")
 
-    def get_intersection_len(self, session_id: str):
+    def get_intersection_len(self, session_id: str, wait_seconds: float = 0):
+        """wait_seconds: wait (long poll) up to this long for the initiator's result. -1 if not (yet) set"""
+        if wait_seconds:
+            return self.wait_for(session_id, "intersection", wait_seconds)["intersection_len"]
         response = requests.get(f"{self.server_url}/psi/{session_id}/intersection", headers=self.headers)
         if not response.ok:
             print(response.json())
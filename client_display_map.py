@@ -1,26 +1,67 @@
 # simple map ui, no server
+import json
+import math
+import time
+from collections import Counter
 
+# nearby users are written as one geojson layer. above this many points, "auto" clusters them
+CLUSTER_MIN_POINTS = 500
+GRID_CELL_DEG = 0.01  # density grid cell size
 
-def create_map_html(true_location, noisy_location, nearby_users=None):
-    nearby_users_points = []
-    if nearby_users:
-        for user in nearby_users:
-            s = f"""
-                var userMarker = L.marker([{user['location']['latitude']}, {user['location']['longitude']}], {{ icon: nearbyMarker }}).addTo(map)
-                    .bindPopup(`<strong>Nearby User</strong><br>User ID: {user['user_id']}<br>Distance: {user['distance']} km`);
-                userMarker.on('mouseover', function(e) {{
-                    info.update({{name: '{user['user_id']}', distance: '{user['distance']} km', user_id: '{user['user_id']}'}}); 
-                }});
-                userMarker.on('mouseout', function(e) {{
-                    info.update();
-                }});
-                """
-            nearby_users_points.append(s)
-    nearby_users_str = "\n".join(nearby_users_points)
 
+def _user_features(nearby_users):
+    for user in nearby_users:
+        yield {
+            "type": "Feature",
+            "geometry": {"type": "Point",
+                         "coordinates": [user['location']['longitude'], user['location']['latitude']]},
+            "properties": {"user_id": user['user_id'], "distance": user['distance']},
+        }
+
+
+def _grid_features(nearby_users, cell_deg=GRID_CELL_DEG):
+    """count of users per grid cell, as polygons"""
+    counts = Counter((math.floor(u['location']['latitude'] / cell_deg), math.floor(u['location']['longitude'] / cell_deg))
+                     for u in nearby_users)
+    for (i, j), count in counts.items():
+        lat, lon = i * cell_deg, j * cell_deg
+        yield {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[
+                [lon, lat], [lon + cell_deg, lat], [lon + cell_deg, lat + cell_deg], [lon, lat + cell_deg], [lon, lat]
+            ]]},
+            "properties": {"count": count},
+        }
+
+
+def _write_feature_collection(f, features):
+    """stream features to file, without building the whole collection in memory"""
+    f.write('{"type": "FeatureCollection", "features": [\n')
+    for i, feature in enumerate(features):
+        if i:
+            f.write(",\n")
+        f.write(json.dumps(feature).replace("</", "<\\/"))  # no "</script>" inside the script tag
+    f.write("\n]}")
+
+
+def create_map_html(true_location, noisy_location, nearby_users=None, layer="auto", filename="map.html"):
+    """layer: markers | cluster | heat | grid (density per cell) | auto (markers, cluster for large sets)"""
+    nearby_users = nearby_users or []
+    if layer == "auto":
+        layer = "cluster" if len(nearby_users) > CLUSTER_MIN_POINTS else "markers"
 
     tile_str = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
 
+    plugins = ""
+    if layer == "cluster":
+        plugins = """
+    <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.css"/>
+    <link rel="stylesheet" href="https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.Default.css"/>
+    <script src="https://unpkg.com/leaflet.markercluster@1.5.3/dist/leaflet.markercluster.js"></script>"""
+    elif layer == "heat":
+        plugins = """
+    <script src="https://unpkg.com/leaflet.heat@0.2.0/dist/leaflet-heat.js"></script>"""
+
     custom = """// Custom Marker Style
                 var trueMarker = L.divIcon({
                     className: 'custom-marker',
@@ -28,24 +69,45 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
                     iconSize: [20, 20],
                     iconAnchor: [10, 20]
                 });
-                
+
                 var noisyMarker = L.divIcon({
                     className: 'custom-marker',
                     html: '<div style="background: blue; border-radius: 50%; width: 14px; height: 14px; border: 2px solid white;"></div>',
                     iconSize: [20, 20],
                     iconAnchor: [10, 20]
                 });
-                
+
                 var nearbyMarker = L.divIcon({
                     className: 'custom-marker',
                     html: '<div style="background: green; border-radius: 50%; width: 10px; height: 10px; border: 2px solid white;"></div>',
                     iconSize: [20, 20],
                     iconAnchor: [10, 20]
                 });
-                
+
             """
 
-    html_content = f"""
+    # one layer + shared handlers for all nearby users (instead of a code block per user)
+    nearby_layers = {
+        "markers": """
+        var nearbyLayer = L.geoJSON(nearbyUsers, {pointToLayer: nearbyPoint, onEachFeature: nearbyFeature}).addTo(map);""",
+        "cluster": """
+        var nearbyLayer = L.markerClusterGroup({chunkedLoading: true});
+        nearbyLayer.addLayer(L.geoJSON(nearbyUsers, {pointToLayer: nearbyPoint, onEachFeature: nearbyFeature}));
+        map.addLayer(nearbyLayer);""",
+        "heat": """
+        var nearbyLayer = L.heatLayer(
+            nearbyUsers.features.map(f => [f.geometry.coordinates[1], f.geometry.coordinates[0]]),
+            {radius: 20, blur: 15}
+        ).addTo(map);""",
+        "grid": """
+        var maxCount = Math.max(1, ...nearbyUsers.features.map(f => f.properties.count));
+        var nearbyLayer = L.geoJSON(nearbyUsers, {
+            style: f => ({color: 'green', weight: 1, fillColor: 'green', fillOpacity: 0.1 + 0.7 * f.properties.count / maxCount}),
+            onEachFeature: (f, l) => l.bindPopup('<strong>Nearby Users</strong><br>' + f.properties.count + ' in cell')
+        }).addTo(map);""",
+    }
+
+    html_head = f"""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -90,8 +152,13 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
 
     <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"
             integrity="sha256-20nQCchB9co0qIjJZRGuk2/Z9VM+kNiyxNV1lvTlZBo="
-            crossorigin=""></script>
+            crossorigin=""></script>{plugins}
     <script>
+        // Nearby Users (geojson)
+        const nearbyUsers = """
+
+    html_body = f""";
+
         // map centered on the true location
         const map = L.map('map').setView([{true_location[0]}, {true_location[1]}], 13);
 
@@ -108,7 +175,7 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
             fillOpacity: 0.3,
             radius: 5000
         }}).addTo(map);
-        
+
         // circle around true location (3 km radius)
         L.circle([{true_location[0]}, {true_location[1]}], {{
             color: 'black',
@@ -116,39 +183,19 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
             fillOpacity: 0.5,
             radius: 3000
         }}).addTo(map);
-        
+
 
         {custom}
-        
+
         // True Location Marker
         L.marker([{true_location[0]}, {true_location[1]}], {{ icon: trueMarker }}).addTo(map)
             .bindPopup(`<strong>True Location</strong><br>Lat: {true_location[0]}<br>Lng: {true_location[1]}`);
-        
+
         // Noisy Location Marker
         L.marker([{noisy_location[0]}, {noisy_location[1]}], {{ icon: noisyMarker }}).addTo(map)
             .bindPopup(`<strong>Noisy Location</strong><br>Lat: {noisy_location[0]}<br>Lng: {noisy_location[1]}`);
-        
-        // Nearby Users
-        {nearby_users_str}
-        
-        L.control.scale({{position:'bottomright', metric: true, imperial: false}}).addTo(map);
-        
-        // legend
-        var legend = L.control({{position: 'topright'}});
-        legend.onAdd = function (map) {{
-            var div = L.DomUtil.create('div', 'info legend');
-            div.innerHTML = `
-                <strong>Legend:</strong><br>
-                <span style="color:black;">● True Location</span><br>
-                <span style="color:blue;">● Noisy Location</span><br>
-                <span style="color:green;">● Nearby User</span
-            `;
-            return div;
-        }};
-        legend.addTo(map);
-        
-        
-        // Custom Info Control    
+
+        // Custom Info Control
         var info = L.control();
         info.onAdd = function (map) {{
             this._div = L.DomUtil.create('div', 'info'); // create a div with a class "info"
@@ -156,21 +203,46 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
             return this._div;
         }};
 
+        function escapeHtml(s) {{
+            return String(s).replace(/[&<>"']/g, c => ({{'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}})[c]);
+        }}
+
         // method that we will use to update the control based on feature properties passed
         info.update = function (props) {{
             this._div.innerHTML = '<h4>Nearby User Info</h4>' +  (props ?
-                '<b>' + props.name + '</b><br/>' + props.distance + ' (from noisy location)'
+                '<b>' + escapeHtml(props.user_id) + '</b><br/>' + props.distance + ' km (from noisy location)'
                 : 'Hover over a green point');
         }};
-        
-        function highlightFeature(e) {{
-            info.update(layer.feature.properties);
+
+        function nearbyPoint(feature, latlng) {{
+            return L.marker(latlng, {{ icon: nearbyMarker }});
         }}
-        
-        function resetHighlight(e) {{
-            info.update();
+
+        function nearbyFeature(feature, layer) {{
+            var p = feature.properties;
+            layer.bindPopup('<strong>Nearby User</strong><br>User ID: ' + escapeHtml(p.user_id) + '<br>Distance: ' + p.distance + ' km');
+            layer.on('mouseover', () => info.update(p));
+            layer.on('mouseout', () => info.update());
         }}
 
+        {nearby_layers[layer]}
+
+        L.control.scale({{position:'bottomright', metric: true, imperial: false}}).addTo(map);
+
+        // legend
+        var legend = L.control({{position: 'topright'}});
+        legend.onAdd = function (map) {{
+            var div = L.DomUtil.create('div', 'info legend');
+            div.innerHTML = `
+                <strong>Legend:</strong><br>
+                <span style="color:black;">● True Location</span><br>
+                <span style="color:blue;">● Noisy Location</span><br>
+                <span style="color:green;">● Nearby User</span
+            `;
+            return div;
+        }};
+        legend.addTo(map);
+
         info.addTo(map);
 
     </script>
@@ -178,9 +250,34 @@ def create_map_html(true_location, noisy_location, nearby_users=None):
     </html>
     """
 
-    # write to file
-    filename = "map.html"
+    # write to file, nearby users streamed as geojson
+    features = _grid_features(nearby_users) if layer == "grid" else _user_features(nearby_users)
     with open(filename, "w", encoding="utf-8") as f:
-        f.write(html_content)
+        f.write(html_head)
+        _write_feature_collection(f, features)
+        f.write(html_body)
 
     return filename
+
+
+def benchmark(counts=(100, 1_000, 10_000, 100_000), layers=("markers", "cluster", "heat", "grid")):
+    """generation time and output size vs number of nearby users"""
+    import os
+    import random
+
+    true_location = (51.5007, -0.1246)
+    for n in counts:
+        users = [{"user_id": f"user_{i}", "distance": round(random.uniform(0, 5), 2),
+                  "location": {"latitude": 51.5 + random.uniform(-0.05, 0.05),
+                               "longitude": -0.12 + random.uniform(-0.08, 0.08)}}
+                 for i in range(n)]
+        for layer in layers:
+            t = time.perf_counter()
+            fname = create_map_html(true_location, true_location, users, layer=layer, filename="map_benchmark.html")
+            elapsed = time.perf_counter() - t
+            print(f"{n:>8,} users  {layer:<8} {elapsed * 1000:9.1f} ms  {os.path.getsize(fname) / 1024:10.1f} KiB")
+    os.remove("map_benchmark.html")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,64 @@
+"""
+encode time per response: default fastapi path vs response model (pydantic) vs orjson / packed values.
+
+usage: python bench_json.py [--repeat 200]
+"""
+import argparse
+import base64
+import json
+import random
+import timeit
+from typing import List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from main import NearbyUser, UserPoint, _nearby_user
+from psi import pack_values, unpack_values
+
+
+def _nearby(n=20):
+    return [_nearby_user(f"user_{i}", random.uniform(0, 5), 51.5 + random.random() / 10, -0.1 + random.random() / 10)
+            for i in range(n)]
+
+
+def _users(n=10_000):
+    return [{"user_id": f"user_{i}", "point": f"POINT({-0.1 + random.random()} {51.5 + random.random()})"}
+            for i in range(n)]
+
+
+def _report(name, repeat, **variants):
+    print(name)
+    for label, fn in variants.items():
+        t = min(timeit.repeat(fn, number=repeat, repeat=3)) / repeat
+        print(f"  {label:<22} {t * 1e6:10.1f} us/response  {len(fn()):>10,} bytes")
+
+
+def main(repeat: int):
+    nearby = _nearby()
+    nearby_model = TypeAdapter(List[NearbyUser])
+    _report("/locations/nearby_users (20 users)", repeat,
+            default=lambda: json.dumps(jsonable_encoder(nearby)).encode(),
+            response_model=lambda: nearby_model.dump_json(nearby_model.validate_python(nearby)),
+            orjson=lambda: orjson.dumps(nearby))
+
+    users = _users()
+    users_model = TypeAdapter(List[UserPoint])
+    _report("/users (10k users)", max(1, repeat // 20),
+            default=lambda: json.dumps(jsonable_encoder(users)).encode(),
+            response_model=lambda: users_model.dump_json(users_model.validate_python(users)),
+            orjson=lambda: orjson.dumps(users))
+
+    packed = pack_values([random.getrandbits(2048) for _ in range(1000)])
+    _report("GET /psi/{session_id} (1000 values)", max(1, repeat // 20),
+            default=lambda: json.dumps(jsonable_encoder({"values": unpack_values(packed), "status": 1})).encode(),
+            int_encoding=lambda: json.dumps({"values": unpack_values(packed), "status": 1}).encode(),
+            b64_encoding=lambda: orjson.dumps({"values": base64.b64encode(packed).decode(), "status": 1}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,71 @@
+"""
+memory per 1k PSI sessions: packed buffers (SessionData) vs lists of python ints (previous representation).
+
+usage: python bench_psi_memory.py [--sessions 1000] [--items 50]
+"""
+import argparse
+import random
+import tracemalloc
+from datetime import datetime, UTC
+
+from psi import SessionData, SessionStatus, pack_values
+
+P_BITS = 2048
+
+
+def _random_values(n):
+    return [random.getrandbits(P_BITS) for _ in range(n)]
+
+
+def _as_lists(initiator_values, response_values):
+    return {
+        "initiator_values": initiator_values,
+        "status": SessionStatus.JOINED.value,
+        "user_id": "initiator",
+        "created_at": datetime.now(UTC),
+        "response_values": {"joiner": response_values},
+        "intersection": {},
+    }
+
+
+def _as_packed(initiator_values, response_values):
+    return SessionData(
+        initiator_values=pack_values(initiator_values),
+        status=SessionStatus.JOINED.value,
+        user_id="initiator",
+        created_at=datetime.now(UTC),
+        response_values={"joiner": pack_values(response_values)},
+    )
+
+
+def measure(build, payloads) -> int:
+    """bytes allocated by build() for all payloads (payload ints themselves excluded)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [build([v for v in x], [v for v in y]) for x, y in payloads]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sessions
+    return after - before
+
+
+def main(n_sessions: int, n_items: int):
+    payloads = [(_random_values(n_items), _random_values(2 * n_items)) for _ in range(n_sessions)]
+    # list copies share the int objects with payloads, count them as the list representation would own them
+    int_bytes = sum(v.__sizeof__() for x, y in payloads for v in x + y)
+
+    lists = measure(_as_lists, payloads) + int_bytes
+    packed = measure(_as_packed, payloads)
+
+    per_1k = 1000 / n_sessions / 2 ** 20
+    print(f"{n_sessions} sessions, {n_items} initiator values + {2 * n_items} response values each")
+    print(f"lists of ints:  {lists * per_1k:8.1f} MiB per 1k sessions")
+    print(f"packed buffers: {packed * per_1k:8.1f} MiB per 1k sessions ({lists / packed:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=50)
+    args = parser.parse_args()
+    main(args.sessions, args.items)
@@ -0,0 +1,91 @@
+"""
+update counter per grid cell, for conditional nearby requests (ETag / If-None-Match).
+
+every location write bumps the counters of the writer's previous and new cell. a nearby result of a user
+in cell c within radius r only depends on users in the cells around c up to r, so the sum of their counters
+(counters only grow) is a version of the result. the tag carries the cell, so If-None-Match is answered
+without any db query: a requester who moved bumped the tag's cell itself.
+counters are per process: tags expire after NEARBY_ETAG_MAX_AGE_SECONDS (time epoch in the tag), which bounds
+staleness from writes handled by other workers. tags from another process generation never match.
+with WORKERS > 1 it is off unless NEARBY_ETAG=1 is set explicitly.
+"""
+import hashlib
+import math
+import os
+import secrets
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Tuple
+
+# counters only see this worker's writes: off by default with several workers
+NEARBY_ETAG_ENABLED = os.getenv("NEARBY_ETAG", "1" if int(os.getenv("WORKERS", 1)) == 1 else "0") == "1"
+NEARBY_ETAG_MAX_AGE_SECONDS = int(os.getenv("NEARBY_ETAG_MAX_AGE_SECONDS", 30))
+CELL_DEG = 0.02
+KM_PER_DEG = 111.32
+MAX_CELLS = 2500  # larger radius: no tag
+
+Cell = Tuple[int, int]
+
+
+def cell_of(latitude: float, longitude: float) -> Cell:
+    return math.floor(latitude / CELL_DEG), math.floor(longitude / CELL_DEG)
+
+
+class CellVersions:
+    def __init__(self, max_age_seconds: int = NEARBY_ETAG_MAX_AGE_SECONDS, enabled: bool = NEARBY_ETAG_ENABLED):
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self.generation = secrets.token_hex(4)
+        self.counters: Dict[Cell, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def bump(self, latitude: float | None, longitude: float | None):
+        if not self.enabled or latitude is None or longitude is None:
+            return
+        with self._lock:
+            self.counters[cell_of(latitude, longitude)] += 1
+
+    def _version(self, cell: Cell, radius_km: float) -> int | None:
+        i, j = cell
+        cell_km_lat = CELL_DEG * KM_PER_DEG
+        # narrowest cell width inside the ring (towards the pole)
+        lat = min(abs(i), abs(i + 1)) * CELL_DEG + radius_km / KM_PER_DEG
+        cell_km_lon = cell_km_lat * math.cos(math.radians(min(lat, 89.0)))
+        di, dj = math.ceil(radius_km / cell_km_lat), math.ceil(radius_km / cell_km_lon)
+        if (2 * di + 1) * (2 * dj + 1) > MAX_CELLS:
+            return None
+        counters = self.counters
+        return sum(counters.get((a, b), 0) for a in range(i - di, i + di + 1) for b in range(j - dj, j + dj + 1))
+
+    def _tag(self, cell: Cell, version: int, key: str) -> str:
+        epoch = int(time.time() // self.max_age_seconds)
+        key_hash = hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+        return f'"{self.generation}.{epoch}.{cell[0]}.{cell[1]}.{version}.{key_hash}"'
+
+    def etag(self, latitude: float, longitude: float, radius_km: float, key: str) -> str | None:
+        """tag of a result computed now for a requester at latitude, longitude. compute before the query:
+        a write that lands during the query then changes the next tag. key: the request parameters"""
+        if not self.enabled:
+            return None
+        cell = cell_of(latitude, longitude)
+        version = self._version(cell, radius_km)
+        return None if version is None else self._tag(cell, version, key)
+
+    def match(self, if_none_match: str | None, radius_km: float, key: str) -> str | None:
+        """the tag in If-None-Match that is still current, if any"""
+        if not self.enabled or not if_none_match:
+            return None
+        for tag in if_none_match.split(","):
+            tag = tag.strip().removeprefix("W/")
+            parts = tag.strip('"').split(".")
+            if len(parts) != 6 or parts[0] != self.generation:
+                continue
+            try:
+                cell = int(parts[2]), int(parts[3])
+            except ValueError:
+                continue
+            version = self._version(cell, radius_km)
+            if version is not None and tag == self._tag(cell, version, key):
+                return tag
+        return None
@@ -1,16 +1,17 @@
 import logging
 import os
 import time
+from contextlib import contextmanager
 from datetime import datetime, UTC
 
-from geoalchemy2 import Geometry
-from sqlalchemy import create_engine, Column, String, DateTime, text, Boolean, ForeignKey
+from geoalchemy2 import Geography
+from sqlalchemy import create_engine, Column, String, DateTime, text, Boolean, ForeignKey, func
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from sample_data import DB_LONDON_VALUES
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
 log = logging.getLogger(__name__)
 
 # db config
@@ -25,8 +26,15 @@ engine = create_engine(DATABASE_URL)
 Base = declarative_base()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+INIT_LOCK_ID = 7_301_001  # pg advisory lock key for one-time schema/seed setup
 LOCATIONS_TABLE_NAME = "user_locations"
 USERS_TABLE_NAME = "users"
+NEARBY_CACHE_TABLE_NAME = "nearby_cache"
+
+
+def is_transient(e: Exception) -> bool:
+    """db unreachable or connection lost: the same statement may succeed later. else the data is at fault"""
+    return isinstance(e, (OperationalError, InterfaceError)) or getattr(e, "connection_invalidated", False)
 
 
 class UserDB(Base):
@@ -35,16 +43,28 @@ class UserDB(Base):
     user_id = Column(String, primary_key=True, index=True)
     hashed_password = Column(String)
     disabled = Column(Boolean, default=False)
+    tokens_valid_after = Column(DateTime(timezone=True))  # tokens issued before are revoked
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  # set by trigger
 
 
 class UserLocation(Base):
     __tablename__ = LOCATIONS_TABLE_NAME
 
     user_id = Column(String, ForeignKey(f"{USERS_TABLE_NAME}.user_id"), primary_key=True, index=True, )
-    location = Column(Geometry('POINT', srid=4326))
+    # native geography: distance/radius queries need no per-row cast. index created in create_base_schema
+    location = Column(Geography('POINT', srid=4326, spatial_index=False))
     last_updated = Column(DateTime, default=datetime.now(UTC))
 
 
+class NearbyCacheEntry(Base):
+    """precomputed top-k neighbours of a user (see nearby_cache.py)"""
+    __tablename__ = NEARBY_CACHE_TABLE_NAME
+
+    user_id = Column(String, ForeignKey(f"{USERS_TABLE_NAME}.user_id"), primary_key=True)
+    neighbours = Column(JSONB, nullable=False)  # [{user_id, distance_km, latitude, longitude}, ...] by distance
+    computed_at = Column(DateTime(timezone=True), nullable=False)
+
+
 def _init_postgis():
     """initialize PostGIS extension before creating tables"""
     num_attempts = 3
@@ -65,26 +85,89 @@ def _init_postgis():
                 time.sleep(sleep_time)
 
 
-def init_db():
-    """create all tables (will not attempt to recreate tables already present)"""
+@contextmanager
+def init_lock():
+    """hold a postgres advisory lock, so replicas starting together run schema/seed setup one at a time"""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": INIT_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": INIT_LOCK_ID})
+
+
+def create_base_schema():
+    """postgis, tables and spatial index as of schema version 1 (migration step 1, frozen: later changes
+    are new steps, the models may have moved on). existing tables are left alone"""
     _init_postgis()
     log.info("create tables")
-    Base.metadata.create_all(bind=engine)
-    _create_spatial_indexes()
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {USERS_TABLE_NAME} (
+            user_id VARCHAR NOT NULL PRIMARY KEY,
+            hashed_password VARCHAR,
+            disabled BOOLEAN
+        )
+        """))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{USERS_TABLE_NAME}_user_id ON {USERS_TABLE_NAME} (user_id)"))
+        conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {LOCATIONS_TABLE_NAME} (
+            user_id VARCHAR NOT NULL PRIMARY KEY REFERENCES {USERS_TABLE_NAME} (user_id),
+            location geography(POINT, 4326),
+            last_updated TIMESTAMP WITHOUT TIME ZONE
+        )
+        """))
+        conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS ix_{LOCATIONS_TABLE_NAME}_user_id ON {LOCATIONS_TABLE_NAME} (user_id)
+        """))
+        conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {NEARBY_CACHE_TABLE_NAME} (
+            user_id VARCHAR NOT NULL PRIMARY KEY REFERENCES {USERS_TABLE_NAME} (user_id),
+            neighbours JSONB NOT NULL,
+            computed_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """))
+        # single GiST index on the geography column
+        conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS idx_{LOCATIONS_TABLE_NAME}_geography
+        ON {LOCATIONS_TABLE_NAME} USING GIST (location)
+        """))
+        conn.commit()
 
 
-def _create_spatial_indexes():
-    """Create optimized spatial indexes"""
+def add_user_revocation_columns():
+    """users.tokens_valid_after and users.updated_at (kept by trigger on every insert/update),
+    read incrementally by the revocation list (revocation.py)"""
     with engine.connect() as conn:
+        conn.execute(text(f"ALTER TABLE {USERS_TABLE_NAME} ADD COLUMN IF NOT EXISTS tokens_valid_after timestamptz"))
+        conn.execute(text(f"""
+        ALTER TABLE {USERS_TABLE_NAME} ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()
+        """))
         conn.execute(text(f"""
-        CREATE INDEX IF NOT EXISTS idx_{LOCATIONS_TABLE_NAME}_geometry 
-        ON {LOCATIONS_TABLE_NAME} USING GIST (location);
+        CREATE INDEX IF NOT EXISTS idx_{USERS_TABLE_NAME}_updated_at ON {USERS_TABLE_NAME} (updated_at)
         """))
         conn.execute(text(f"""
-        CREATE INDEX IF NOT EXISTS idx_{LOCATIONS_TABLE_NAME}_geography 
-        ON {LOCATIONS_TABLE_NAME} USING GIST ((location::geography));
+        CREATE OR REPLACE FUNCTION {USERS_TABLE_NAME}_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = clock_timestamp();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
         """))
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {USERS_TABLE_NAME}_updated_at ON {USERS_TABLE_NAME}"))
+        conn.execute(text(f"""
+        CREATE TRIGGER {USERS_TABLE_NAME}_updated_at BEFORE INSERT OR UPDATE ON {USERS_TABLE_NAME}
+        FOR EACH ROW EXECUTE FUNCTION {USERS_TABLE_NAME}_touch_updated_at()
+        """))
+        conn.commit()
+
 
+def add_nearby_cache_computed_at_index():
+    """oldest first scan of nearby_cache for the stale refresh (nearby_cache.py)"""
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS idx_{NEARBY_CACHE_TABLE_NAME}_computed_at ON {NEARBY_CACHE_TABLE_NAME} (computed_at)
+        """))
         conn.commit()
 
 
@@ -0,0 +1,189 @@
+"""
+in-memory user count per grid cell (DENSITY_GRID=1).
+rebuilt from user_locations in the background, adjusted in between by location writes of this process.
+used to pick a nearby search radius that holds about k users (adaptive nearby search),
+and as user count per web mercator tile for zoom 0..DENSITY_TILE_MAX_ZOOM (heatmap tiles).
+"""
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+from db_ import SessionLocal, LOCATIONS_TABLE_NAME
+
+log = logging.getLogger(__name__)
+
+DENSITY_GRID_ENABLED = os.getenv("DENSITY_GRID", "0") == "1"
+DENSITY_CELL_DEG = 0.01  # ~1.1 km north-south
+DENSITY_REBUILD_SECONDS = 300
+KM_PER_DEG = 111.32
+MIN_RADIUS_KM = 0.2
+MAX_RINGS = 60  # cells counted outwards at most (~66 km), bounds the lookups per request
+RADIUS_MARGIN = 1.3  # density is uneven inside the counted cells, aim a bit wider
+DENSITY_TILE_MAX_ZOOM = 14  # ~1.5 km tiles at london latitude
+MAX_LATITUDE = 85.0511  # web mercator
+
+Cell = Tuple[int, int]
+Tile = Tuple[int, int]  # x, y
+
+
+def cell_of(latitude: float, longitude: float, cell_deg: float = DENSITY_CELL_DEG) -> Cell:
+    return math.floor(latitude / cell_deg), math.floor(longitude / cell_deg)
+
+
+def tile_of(latitude: float, longitude: float, zoom: int) -> Tile:
+    """slippy map tile (web mercator) of a point"""
+    n = 1 << zoom
+    lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _tile_pyramid(max_zoom_counts: Dict[Tile, int], max_zoom: int) -> List[Dict[Tile, int]]:
+    """counts per zoom 0..max_zoom, summed up from the max zoom tiles"""
+    tiles = [defaultdict(int) for _ in range(max_zoom + 1)]
+    tiles[max_zoom].update(max_zoom_counts)
+    for zoom in range(max_zoom, 0, -1):
+        parent = tiles[zoom - 1]
+        for (x, y), n in tiles[zoom].items():
+            parent[(x >> 1, y >> 1)] += n
+    return tiles
+
+
+class DensityGrid:
+    def __init__(self, cell_deg: float = DENSITY_CELL_DEG, max_zoom: int = DENSITY_TILE_MAX_ZOOM,
+                 enabled: bool = DENSITY_GRID_ENABLED):
+        self.cell_deg = cell_deg
+        self.max_zoom = max_zoom
+        self.enabled = enabled
+        self.counts: Dict[Cell, int] = defaultdict(int)
+        self.tiles: List[Dict[Tile, int]] = _tile_pyramid({}, max_zoom)  # per zoom: tile -> users
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rebuild(self):
+        q = text(f"""
+        SELECT
+            floor(ST_Y(location::geometry) / :cell_deg)::int AS i,
+            floor(ST_X(location::geometry) / :cell_deg)::int AS j,
+            count(*)
+        FROM {LOCATIONS_TABLE_NAME}
+        WHERE location IS NOT NULL
+        GROUP BY 1, 2
+        """)
+        # tiles at max zoom: same formula as tile_of
+        q_tiles = text(f"""
+        WITH p AS (
+            SELECT ST_X(location::geometry) AS lon,
+                   radians(greatest(-{MAX_LATITUDE}, least({MAX_LATITUDE}, ST_Y(location::geometry)))) AS lat
+            FROM {LOCATIONS_TABLE_NAME}
+            WHERE location IS NOT NULL
+        )
+        SELECT
+            least(greatest(floor((lon + 180) / 360 * :n), 0), :n - 1)::int AS x,
+            least(greatest(floor((1 - asinh(tan(lat)) / pi()) / 2 * :n), 0), :n - 1)::int AS y,
+            count(*)
+        FROM p
+        GROUP BY 1, 2
+        """)
+        with SessionLocal() as session:
+            counts = defaultdict(int, {(i, j): n for i, j, n in session.execute(q, {"cell_deg": self.cell_deg})})
+            tiles = {(x, y): n for x, y, n in session.execute(q_tiles, {"n": 1 << self.max_zoom})}
+        tiles = _tile_pyramid(tiles, self.max_zoom)
+        with self._lock:
+            self.counts = counts
+            self.tiles = tiles
+        log.debug(f"density grid rebuilt: {len(counts)} cells, {len(tiles[-1])} tiles at zoom {self.max_zoom}")
+
+    def move(self, prev_latitude: float | None, prev_longitude: float | None,
+             latitude: float | None, longitude: float | None):
+        """apply a location write: one user leaves prev cell (if any), enters new cell"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if prev_latitude is not None and prev_longitude is not None:
+                prev = cell_of(prev_latitude, prev_longitude, self.cell_deg)
+                self.counts[prev] = max(0, self.counts[prev] - 1)
+                x, y = tile_of(prev_latitude, prev_longitude, self.max_zoom)
+                for zoom in range(self.max_zoom, -1, -1):
+                    tiles = self.tiles[zoom]
+                    tiles[(x, y)] = max(0, tiles[(x, y)] - 1)
+                    x, y = x >> 1, y >> 1
+            if latitude is not None and longitude is not None:
+                self.counts[cell_of(latitude, longitude, self.cell_deg)] += 1
+                x, y = tile_of(latitude, longitude, self.max_zoom)
+                for zoom in range(self.max_zoom, -1, -1):
+                    self.tiles[zoom][(x, y)] += 1
+                    x, y = x >> 1, y >> 1
+
+    def tile_counts(self, zoom: int, x: int, y: int, detail: int) -> List[Tuple[int, int, int]]:
+        """users per sub tile of tile zoom/x/y, detail levels deeper (capped at max zoom): [(x, y, count)].
+        empty sub tiles are left out"""
+        detail = min(detail, self.max_zoom - zoom)
+        x0, y0, size = x << detail, y << detail, 1 << detail
+        with self._lock:
+            tiles = self.tiles[zoom + detail]
+            cells = [(i, j, tiles.get((i, j), 0)) for i in range(x0, x0 + size) for j in range(y0, y0 + size)]
+        return [cell for cell in cells if cell[2] > 0]
+
+    def effective_radius(self, latitude: float, longitude: float, k: int, max_distance_km: float) -> float:
+        """radius (km) expected to hold about k other users around (latitude, longitude), at most max_distance_km.
+        counts rings of cells around the user's cell until they hold k + 1 users (the user included).
+        counts are read without the lock (dict lookups only): writers are not blocked, a concurrent move
+        shifts the estimate by one user at most"""
+        if not self.enabled or latitude is None or longitude is None:
+            return max_distance_km
+
+        cell_km_lat = self.cell_deg * KM_PER_DEG
+        cell_km_lon = max(cell_km_lat * math.cos(math.radians(latitude)), 1e-3)
+        max_rings = min(math.ceil(max_distance_km / min(cell_km_lat, cell_km_lon)), MAX_RINGS)
+        i0, j0 = cell_of(latitude, longitude, self.cell_deg)
+
+        total = 0
+        counts = self.counts  # replaced, not cleared, by rebuild
+        for n in range(max_rings + 1):
+            if n == 0:
+                total += counts.get((i0, j0), 0)
+            else:
+                for d in range(-n, n + 1):
+                    total += (counts.get((i0 - n, j0 + d), 0) + counts.get((i0 + n, j0 + d), 0))
+                    if abs(d) != n:
+                        total += (counts.get((i0 + d, j0 - n), 0) + counts.get((i0 + d, j0 + n), 0))
+            if total > k:
+                break
+
+        if total <= 1:
+            return max_distance_km
+        area_km2 = (2 * n + 1) ** 2 * cell_km_lat * cell_km_lon
+        radius = RADIUS_MARGIN * math.sqrt((k + 1) / (math.pi * total / area_km2))
+        return min(max(radius, MIN_RADIUS_KM), max_distance_km)
+
+    # background job
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.rebuild()
+            except Exception as e:
+                log.error(f"density grid rebuild failed: {e}")
+            self._stop.wait(DENSITY_REBUILD_SECONDS)
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        log.info(f"start density grid ({self.cell_deg} deg cells)")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="density-grid", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
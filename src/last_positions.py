@@ -0,0 +1,58 @@
+"""
+no-op location update suppression. clients snap noisy points to a grid, so a stationary user
+sends the same point again and again. the last written point per user is kept in memory:
+- same point, written less than LOCATION_HEARTBEAT_SECONDS ago: no db write at all (last_updated lags by at most that)
+- same point, heartbeat due: only last_updated is bumped (HOT update, no index changes)
+- else: regular upsert
+per process, bounded by LAST_POSITIONS_MAX users (oldest written dropped first).
+the upsert itself is conditional too, for points this process has not seen (other worker, restart).
+with several workers a SKIP can be stale: a move handled by another worker is not seen here, and the
+same point sent again within the heartbeat is dropped, so the stored point can lag for up to
+LOCATION_HEARTBEAT_SECONDS. a touch only applies to the point this process wrote, else it falls back to the upsert.
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+LOCATION_HEARTBEAT_SECONDS = float(os.getenv("LOCATION_HEARTBEAT_SECONDS", 60))
+LAST_POSITIONS_MAX = int(os.getenv("LAST_POSITIONS_MAX", 1_000_000))
+
+WRITE, TOUCH, SKIP = "write", "touch", "skip"
+
+
+class LastPositions:
+    def __init__(self, heartbeat_seconds: float = LOCATION_HEARTBEAT_SECONDS, max_users: int = LAST_POSITIONS_MAX,
+                 enabled: bool = LOCATION_HEARTBEAT_SECONDS > 0):
+        self.heartbeat = timedelta(seconds=heartbeat_seconds)
+        self.max_users = max_users
+        self.enabled = enabled
+        self._positions: Dict[str, Tuple[float, float, datetime]] = {}  # user_id -> lat, lon, last write
+        self._lock = threading.Lock()
+        self.counters = {WRITE: 0, TOUCH: 0, SKIP: 0}
+
+    def check(self, user_id: str, latitude: float, longitude: float, now: datetime) -> str:
+        """WRITE (moved or unknown), TOUCH (same point, heartbeat due) or SKIP (same point, recently written)"""
+        if not self.enabled:
+            return WRITE
+        last = self._positions.get(user_id)
+        if last is None or last[0] != latitude or last[1] != longitude:
+            action = WRITE
+        elif now - last[2] < self.heartbeat:
+            action = SKIP
+        else:
+            action = TOUCH
+        self.counters[action] += 1
+        return action
+
+    def written(self, user_id: str, latitude: float, longitude: float, at: datetime):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._positions.pop(user_id, None)  # re-insert: dict order is write order
+            self._positions[user_id] = (latitude, longitude, at)
+            if len(self._positions) > self.max_users:
+                del self._positions[next(iter(self._positions))]
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "users": len(self._positions)}
@@ -0,0 +1,180 @@
+"""
+admission control for expensive routes (http middleware):
+- token bucket per (route, user) - user from the bearer token, client ip if none.
+  login has no token yet: bucket per form username, plus one per client ip across usernames
+- global cap on in-flight requests for db/cpu bound routes, excess is shed instead of queued
+both answer 429 with Retry-After. limits are per process.
+a request counts as in flight until its response body is sent (streamed bodies run their queries lazily).
+"""
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Tuple
+from urllib.parse import parse_qs
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from sec import token_subject
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1") == "1"
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", 15))  # default sqlalchemy pool: 5 + 10 overflow
+MAX_BUCKETS = 100_000
+
+Route = Tuple[str, str]  # method, path
+
+# route: (tokens per second, burst)
+RATE_LIMITS: Dict[Route, Tuple[float, int]] = {
+    ("POST", "/login_for_access_token"): (10 / 60, 10),  # bcrypt
+    ("POST", "/refresh_access_token"): (1, 10),
+    ("GET", "/locations/nearby_users"): (2, 10),
+    ("POST", "/locations"): (5, 20),
+    ("GET", "/users"): (0.2, 2),
+    ("POST", "/psi/init"): (1, 5),
+    ("POST", "/psi/uploads"): (1, 5),
+}
+
+# route: form field keying the rate bucket instead of the token (form body, no token yet)
+RATE_KEY_FIELDS: Dict[Route, str] = {
+    ("POST", "/login_for_access_token"): "username",
+}
+
+# route: (tokens per second, burst) of a second bucket per client ip, across all rate keys
+IP_RATE_LIMITS: Dict[Route, Tuple[float, int]] = {
+    ("POST", "/login_for_access_token"): (1, 30),  # password spraying over many usernames
+}
+
+# route: max in flight (all users)
+CONCURRENCY_LIMITS: Dict[Route, int] = {
+    ("POST", "/login_for_access_token"): DB_CONCURRENCY,
+    ("GET", "/locations/nearby_users"): DB_CONCURRENCY,
+    ("POST", "/locations/nearby_users/batch"): max(1, DB_CONCURRENCY // 5),
+    ("POST", "/locations"): DB_CONCURRENCY,
+    ("GET", "/users"): max(1, DB_CONCURRENCY // 5),
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """0 if a token is available, else seconds until one is"""
+        self._refill(time.monotonic())
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> float:
+        """take one token. returns 0 if allowed, else seconds until a token is available"""
+        wait = self.wait_time()
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class AdmissionControl:
+    def __init__(self, rate_limits=RATE_LIMITS, concurrency_limits=CONCURRENCY_LIMITS, enabled=RATE_LIMIT_ENABLED,
+                 rate_key_fields=RATE_KEY_FIELDS, ip_rate_limits=IP_RATE_LIMITS):
+        self.rate_limits = rate_limits
+        self.rate_key_fields = rate_key_fields
+        self.ip_rate_limits = ip_rate_limits
+        self.concurrency_limits = concurrency_limits
+        self.enabled = enabled
+        self.buckets: Dict[Tuple[Route, str], TokenBucket] = {}
+        self.in_flight: Dict[Route, int] = defaultdict(int)
+        self.counters: Dict[Route, Dict[str, int]] = defaultdict(lambda: {"allowed": 0, "limited": 0, "shed": 0})
+
+    def _bucket(self, route: Route, key: str, limits: Tuple[float, int]) -> TokenBucket:
+        bucket = self.buckets.get((route, key))
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = self.buckets[(route, key)] = TokenBucket(*limits)
+        return bucket
+
+    async def _rate_key(self, route: Route, request: Request, ip: str) -> str:
+        field = self.rate_key_fields.get(route)
+        if field:
+            # body is cached by the request, the route reads it again
+            values = parse_qs((await request.body()).decode(errors="replace")).get(field)
+            if values and values[0].strip():
+                return f"{field}:{values[0].strip().lower()}"
+        else:
+            subject = token_subject(request.headers.get("authorization"))
+            if subject:
+                return f"user:{subject}"
+        return f"ip:{ip}"
+
+    def _prune(self):
+        """drop buckets that refilled completely (same as a new bucket)"""
+        now = time.monotonic()
+        self.buckets = {k: b for k, b in self.buckets.items() if not b.is_full(now)}
+
+    @staticmethod
+    def _too_many(retry_after: float, detail: str) -> JSONResponse:
+        return JSONResponse(status_code=429, content={"detail": detail},
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    async def __call__(self, request: Request, call_next):
+        route = (request.method, request.url.path.rstrip("/") or "/")
+        if not self.enabled or (route not in self.rate_limits and route not in self.concurrency_limits):
+            return await call_next(request)
+
+        if route in self.rate_limits:
+            ip = request.client.host if request.client else "-"
+            buckets = [self._bucket(route, await self._rate_key(route, request, ip), self.rate_limits[route])]
+            if route in self.ip_rate_limits:
+                buckets.append(self._bucket(route, f"ip_total:{ip}", self.ip_rate_limits[route]))
+            # tokens are taken only if all buckets (and the concurrency cap) let the request through
+            retry_after = max(bucket.wait_time() for bucket in buckets)
+            if retry_after:
+                self.counters[route]["limited"] += 1
+                return self._too_many(retry_after, "Too many requests")
+        else:
+            buckets = []
+
+        limit = self.concurrency_limits.get(route)
+        if limit is not None and self.in_flight[route] >= limit:
+            self.counters[route]["shed"] += 1
+            return self._too_many(1, "Server busy")
+
+        for bucket in buckets:
+            bucket.take()
+        self.counters[route]["allowed"] += 1
+        self.in_flight[route] += 1
+        try:
+            response = await call_next(request)
+        except BaseException:
+            self.in_flight[route] -= 1
+            raise
+
+        body = response.body_iterator
+
+        async def body_then_release():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                self.in_flight[route] -= 1
+
+        response.body_iterator = body_then_release()
+        return response
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {f"{method} {path}": {**counters, "in_flight": self.in_flight[(method, path)]}
+                for (method, path), counters in self.counters.items()}
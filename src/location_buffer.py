@@ -0,0 +1,114 @@
+"""
+optional write coalescing for location updates (LOCATION_WRITE_MODE=buffered).
+
+keeps only the last point per user in memory and flushes all of them as one batched upsert
+every LOCATION_FLUSH_INTERVAL_MS or as soon as LOCATION_FLUSH_MAX_ROWS users are pending, and on shutdown.
+trade-off: updates accepted but not yet flushed (at most one interval) are lost if the process dies,
+and are not yet visible to nearby queries.
+a failed batch is put back only if the db is unavailable. otherwise it is written row by row and rows that
+still fail are dropped, so one bad row does not block everyone else's updates.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from db_ import is_transient
+
+log = logging.getLogger(__name__)
+
+LOCATION_WRITE_MODE = os.getenv("LOCATION_WRITE_MODE", "sync")  # sync | buffered
+LOCATION_FLUSH_INTERVAL_MS = int(os.getenv("LOCATION_FLUSH_INTERVAL_MS", 200))
+LOCATION_FLUSH_MAX_ROWS = int(os.getenv("LOCATION_FLUSH_MAX_ROWS", 1000))
+
+LocationRow = Tuple[str, float, float, datetime]  # user_id, latitude, longitude, timestamp
+
+
+class LocationWriteBuffer:
+    def __init__(self, flush_fn: Callable[[List[LocationRow]], None],
+                 interval_ms: int = LOCATION_FLUSH_INTERVAL_MS, max_rows: int = LOCATION_FLUSH_MAX_ROWS,
+                 enabled: bool = LOCATION_WRITE_MODE == "buffered"):
+        self.flush_fn = flush_fn
+        self.interval_ms = interval_ms
+        self.max_rows = max_rows
+        self.enabled = enabled
+        self.dropped = 0
+        self._pending: Dict[str, LocationRow] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, row: LocationRow):
+        with self._lock:
+            self._pending[row[0]] = row  # last point per user wins
+            full = len(self._pending) >= self.max_rows
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = list(self._pending.values()), {}
+            if not rows:
+                return 0
+
+            try:
+                self.flush_fn(rows)
+            except Exception as e:
+                log.error(f"flush of {len(rows)} location updates failed: {e}")
+                if is_transient(e):
+                    self._put_back(rows)
+                    return 0
+                return self._flush_rows(rows)
+
+            log.debug(f"flushed {len(rows)} location updates")
+            return len(rows)
+
+    def _flush_rows(self, rows: List[LocationRow]) -> int:
+        """one row at a time after a failed batch: drop the rows at fault"""
+        n = 0
+        for i, row in enumerate(rows):
+            try:
+                self.flush_fn([row])
+                n += 1
+            except Exception as e:
+                if is_transient(e):
+                    self._put_back(rows[i:])
+                    break
+                self.dropped += 1
+                log.warning(f"drop location update of {row[0]}: {e}")
+        return n
+
+    def _put_back(self, rows: List[LocationRow]):
+        with self._lock:
+            # unless a newer point arrived meanwhile
+            for row in rows:
+                self._pending.setdefault(row[0], row)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval_ms / 1000)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        log.info(f"start buffered location writes (every {self.interval_ms}ms or {self.max_rows} rows)")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop background flushing and flush what is left"""
+        if self._thread:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        n = self.flush()
+        if n:
+            log.info(f"flushed {n} location updates on shutdown")
@@ -0,0 +1,222 @@
+"""
+append-only location history (LOCATION_HISTORY=1), for analytics and abuse detection.
+
+location_history is range partitioned by day on recorded_at (utc), with a BRIN index on recorded_at:
+rows arrive in time order, so a few block ranges per partition cover any time window.
+location updates are queued in memory and inserted in batches by a background thread,
+no latency on the update path. unwritten rows are lost if the process dies, and dropped
+beyond LOCATION_HISTORY_MAX_PENDING while the db is unavailable.
+rows outside the days that have partitions are dropped before the insert. a batch failing for any other
+reason than the db being unavailable is split in halves down to the failing rows, which are dropped.
+partitions are created LOCATION_HISTORY_DAYS_AHEAD days ahead, partitions older than
+LOCATION_HISTORY_RETENTION_DAYS are dropped (retention is a cheap DROP TABLE, no DELETE/vacuum).
+
+usage: python location_history.py [--maintain]
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, UTC
+from typing import List
+
+from sqlalchemy import text
+
+from db_ import engine, SessionLocal, INIT_LOCK_ID, is_transient
+from location_buffer import LocationRow
+
+log = logging.getLogger(__name__)
+
+LOCATION_HISTORY_ENABLED = os.getenv("LOCATION_HISTORY", "0") == "1"
+LOCATION_HISTORY_FLUSH_INTERVAL_MS = int(os.getenv("LOCATION_HISTORY_FLUSH_INTERVAL_MS", 1000))
+LOCATION_HISTORY_MAX_PENDING = int(os.getenv("LOCATION_HISTORY_MAX_PENDING", 100_000))
+LOCATION_HISTORY_RETENTION_DAYS = int(os.getenv("LOCATION_HISTORY_RETENTION_DAYS", 30))
+LOCATION_HISTORY_DAYS_AHEAD = 2
+MAINTENANCE_INTERVAL_SECONDS = 3600
+MAINTENANCE_LOCK_ID = INIT_LOCK_ID + 1  # one replica at a time
+
+HISTORY_TABLE_NAME = "location_history"
+
+
+def _partition_name(day: date) -> str:
+    return f"{HISTORY_TABLE_NAME}_{day:%Y%m%d}"
+
+
+def create_location_history():
+    """partitioned table and brin index (migration step), partitions for the next days"""
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {HISTORY_TABLE_NAME} (
+            user_id text NOT NULL,
+            location geography(Point, 4326) NOT NULL,
+            recorded_at timestamptz NOT NULL
+        ) PARTITION BY RANGE (recorded_at)
+        """))
+        # on the partitioned table: created on every partition
+        conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS idx_{HISTORY_TABLE_NAME}_recorded_at
+        ON {HISTORY_TABLE_NAME} USING BRIN (recorded_at)
+        """))
+        conn.commit()
+    maintain_partitions()
+
+
+def maintain_partitions(retention_days: int = LOCATION_HISTORY_RETENTION_DAYS,
+                        days_ahead: int = LOCATION_HISTORY_DAYS_AHEAD):
+    """create missing daily partitions up to days_ahead, drop partitions older than retention_days"""
+    today = datetime.now(UTC).date()
+    with engine.connect() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": MAINTENANCE_LOCK_ID}).scalar():
+            log.debug(f"partition maintenance running elsewhere")
+            conn.rollback()
+            return
+
+        for day in (today + timedelta(days=i) for i in range(days_ahead + 1)):
+            conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {_partition_name(day)} PARTITION OF {HISTORY_TABLE_NAME}
+            FOR VALUES FROM ('{day.isoformat()} 00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00+00')
+            """))
+
+        partitions = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table_name
+        """), {"table_name": HISTORY_TABLE_NAME}).scalars().all()
+        oldest = _partition_name(today - timedelta(days=retention_days))
+        for name in sorted(partitions):
+            if name < oldest:  # yyyymmdd suffix sorts by day
+                log.info(f"drop expired location history partition {name}")
+                conn.execute(text(f"DROP TABLE {name}"))
+        conn.commit()
+
+
+class LocationHistoryWriter:
+    def __init__(self, interval_ms: int = LOCATION_HISTORY_FLUSH_INTERVAL_MS,
+                 max_pending: int = LOCATION_HISTORY_MAX_PENDING, enabled: bool = LOCATION_HISTORY_ENABLED):
+        self.interval_ms = interval_ms
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self.dropped = 0
+        self._pending: List[LocationRow] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, row: LocationRow):
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(row)
+
+    def _insert(self, rows: List[LocationRow]):
+        user_ids, latitudes, longitudes, timestamps = zip(*rows)
+        with SessionLocal() as session:
+            session.execute(text(f"""
+            INSERT INTO {HISTORY_TABLE_NAME} (user_id, location, recorded_at)
+            SELECT user_id, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography, recorded_at
+            FROM unnest(
+                CAST(:user_ids AS text[]), CAST(:latitudes AS float8[]),
+                CAST(:longitudes AS float8[]), CAST(:timestamps AS timestamptz[])
+            ) AS t(user_id, latitude, longitude, recorded_at)
+            """), {
+                'user_ids': list(user_ids),
+                'latitudes': list(latitudes),
+                'longitudes': list(longitudes),
+                'timestamps': list(timestamps),
+            })
+            session.commit()
+
+    def _in_partitions(self, rows: List[LocationRow]) -> List[LocationRow]:
+        """rows on days that have a partition (see maintain_partitions)"""
+        today = datetime.now(UTC).date()
+        first = today - timedelta(days=LOCATION_HISTORY_RETENTION_DAYS)
+        last = today + timedelta(days=LOCATION_HISTORY_DAYS_AHEAD)
+        kept = [row for row in rows if first <= row[3].astimezone(UTC).date() <= last]
+        if len(kept) < len(rows):
+            self.dropped += len(rows) - len(kept)
+            log.warning(f"drop {len(rows) - len(kept)} location history rows outside {first}..{last}")
+        return kept
+
+    def _put_back(self, rows: List[LocationRow]):
+        with self._lock:
+            # in front (time order), within the bound
+            keep = max(0, self.max_pending - len(self._pending))
+            self.dropped += len(rows) - min(keep, len(rows))
+            self._pending = rows[:keep] + self._pending
+
+    def flush(self) -> int:
+        with self._lock:
+            rows, self._pending = self._pending, []
+        rows = self._in_partitions(rows)
+        if not rows:
+            return 0
+
+        n = 0
+        batches = [rows]  # stack, next batch last
+        while batches:
+            batch = batches.pop()
+            try:
+                self._insert(batch)
+                n += len(batch)
+            except Exception as e:
+                if is_transient(e):
+                    log.error(f"insert of {len(batch)} location history rows failed: {e}")
+                    self._put_back(batch + [row for rest in reversed(batches) for row in rest])
+                    break
+                if len(batch) == 1:
+                    self.dropped += 1
+                    log.warning(f"drop location history row of {batch[0][0]}: {e}")
+                    continue
+                mid = len(batch) // 2
+                batches += [batch[mid:], batch[:mid]]
+
+        if n:
+            log.debug(f"inserted {n} location history rows")
+        return n
+
+    def _run(self):
+        next_maintenance = 0
+        while not self._stop.wait(self.interval_ms / 1000):
+            self.flush()
+            if time.monotonic() >= next_maintenance:
+                next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL_SECONDS
+                try:
+                    maintain_partitions()
+                except Exception as e:
+                    log.error(f"location history partition maintenance failed: {e}")
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        log.info(f"start location history writes (every {self.interval_ms}ms, "
+                 f"retention {LOCATION_HISTORY_RETENTION_DAYS} days)")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-history", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop background writes and write what is left"""
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        n = self.flush()
+        if n:
+            log.info(f"inserted {n} location history rows on shutdown")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--maintain", action="store_true", help="create upcoming / drop expired partitions")
+    args = parser.parse_args()
+    if args.maintain:
+        maintain_partitions()
+    else:
+        create_location_history()
@@ -1,43 +1,301 @@
+import asyncio
 import logging
+import os
+from contextlib import asynccontextmanager
 from datetime import datetime, UTC
-from typing import List, Dict
+from itertools import groupby
+from typing import List, Dict, Literal
 
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from sqlalchemy import text
 
-from db_ import LOCATIONS_TABLE_NAME, init_db, insert_location_data, USERS_TABLE_NAME, SessionLocal
-from sec import create_initial_user, currUserDep, router as sec_router
-from psi import router as psi_router
-
-from sample_data import DB_LONDON_VALUES
+from cell_versions import CellVersions
+from db_ import LOCATIONS_TABLE_NAME, SessionLocal
+from density import DensityGrid
+from last_positions import LastPositions, LOCATION_HEARTBEAT_SECONDS, SKIP, TOUCH
+from limiter import AdmissionControl
+from location_buffer import LocationWriteBuffer, LocationRow
+from location_history import LocationHistoryWriter
+from migrations import migrate
+from nearby_cache import NearbyCache
+from profiler import RequestProfiler
+from responses import json_response, raw_json_response
+from sec import currUserDep, serviceDep, revocations, router as sec_router
+from psi import router as psi_router, sweep_expired
 
 MAX_NUM_USERS_NEARBY = 20
+MAX_BATCH_USER_IDS = 1000
+NEARBY_OVERSAMPLE = 2  # knn candidates per result in two-phase ranking (sphere and spheroid order differ slightly)
+SPHERE_SLACK = 1.006  # sphere vs spheroid distance differ by < 0.6%
+MAX_TILE_DETAIL = 6  # 64 x 64 sub tiles per density tile
+MAX_NEARBY_DISTANCE_KM = 100.0
+
+DEBUG = os.getenv("DEBUG", "0") == "1"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+WORKERS = int(os.getenv("WORKERS", 1))
+PORT = int(os.getenv("PORT", 8000))
 
-logging.basicConfig(level=logging.DEBUG,
+logging.basicConfig(level=LOG_LEVEL,
                     format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
 log = logging.getLogger(__name__)
 
-app = FastAPI(debug=True)
+nearby_cache = NearbyCache(k=MAX_NUM_USERS_NEARBY)
+density_grid = DensityGrid()
+last_positions = LastPositions()
+cell_versions = CellVersions()
+location_history = LocationHistoryWriter()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    revocations.start()
+    nearby_cache.start()
+    density_grid.start()
+    location_buffer.start()
+    location_history.start()
+    profiler.start()
+    psi_sweeper = asyncio.create_task(sweep_expired())
+    yield
+    psi_sweeper.cancel()
+    profiler.stop()
+    location_history.stop()
+    location_buffer.stop()
+    density_grid.stop()
+    nearby_cache.stop()
+    revocations.stop()
+
+
+app = FastAPI(debug=DEBUG, lifespan=lifespan)
 app.include_router(sec_router)
 app.include_router(psi_router)
+profiler = RequestProfiler()
+app.middleware("http")(profiler)  # inner: rejected requests are not profiled
+admission_control = AdmissionControl()
+app.middleware("http")(admission_control)
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    # as the default handler, but orjson: rejected NaN / inf inputs are echoed as null instead of failing with 500
+    return json_response({"detail": jsonable_encoder(exc.errors())}, status_code=422)
 
 
 class LocationUpdate(BaseModel):
     user_id: str
+    latitude: float = Field(..., ge=-90, le=90, allow_inf_nan=False)
+    longitude: float = Field(..., ge=-180, le=180, allow_inf_nan=False)
+
+
+class Location(BaseModel):
     latitude: float
     longitude: float
 
 
-@app.get("/users")
+class NearbyUser(BaseModel):
+    user_id: str
+    distance: float  # km
+    location: Location
+
+
+class UserPoint(BaseModel):
+    user_id: str
+    point: str | None  # WKT
+
+
+class ProfilerConfig(BaseModel):
+    enabled: bool | None = None
+    sample_rate: float | None = Field(None, ge=0, le=1)
+    routes: List[str] | None = None
+
+
+class NearbyBatchRequest(BaseModel):
+    user_ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_USER_IDS)
+    max_distance: float = Field(5.0, gt=0, le=MAX_NEARBY_DISTANCE_KM)
+
+
+def _nearby_user(user_id: str, distance_km: float, latitude: float, longitude: float) -> Dict[str, object]:
+    return {
+        "user_id": user_id,
+        "distance": round(distance_km, 2),
+        "location": {"latitude": latitude, "longitude": longitude}
+    }
+
+
+# statements of the hot routes, module level so plan_check.py explains exactly these
+USER_POINT_QUERY = text(f"""SELECT ST_Y(location::geometry), ST_X(location::geometry) 
+FROM {LOCATIONS_TABLE_NAME} WHERE user_id = :user_id""")
+
+ALL_USERS_QUERY = text(f"""
+SELECT COALESCE(json_agg(json_build_object('user_id', user_id, 'point', ST_AsText(location))), '[]')::text
+FROM {LOCATIONS_TABLE_NAME};
+""")
+
+NEARBY_QUERY = text(f"""
+SELECT
+    other.user_id,
+    ST_Distance(other.location, base.location) / 1000 as distance_km,
+    ST_X(other.location::geometry) as longitude, ST_Y(other.location::geometry) as latitude
+FROM 
+    {LOCATIONS_TABLE_NAME} AS base
+JOIN 
+    {LOCATIONS_TABLE_NAME} AS other ON other.user_id != base.user_id
+WHERE 
+    base.user_id = :user_id
+    AND ST_DWithin(
+        other.location, -- geography column, accurate distance calculation
+        base.location,
+        :max_distance * 1000  -- meters
+    )
+ORDER BY distance_km
+LIMIT {MAX_NUM_USERS_NEARBY};
+""")
+
+# two-phase ranking (adaptive mode, precision fast/sphere): candidates in index knn order (sphere distance,
+# stops after k * oversample), exact distance (spheroid, or sphere if :spheroid is false) only for those
+NEARBY_KNN_QUERY = text(f"""
+SELECT user_id, distance_km, longitude, latitude
+FROM (
+    SELECT
+        knn.user_id,
+        ST_Distance(knn.location, base.location, :spheroid) / 1000 as distance_km,
+        ST_X(knn.location::geometry) as longitude, ST_Y(knn.location::geometry) as latitude
+    FROM 
+        {LOCATIONS_TABLE_NAME} AS base
+    CROSS JOIN LATERAL (
+        SELECT other.user_id, other.location
+        FROM {LOCATIONS_TABLE_NAME} AS other
+        WHERE other.user_id != base.user_id
+            AND ST_DWithin(other.location, base.location, :max_distance * 1000 * {SPHERE_SLACK}, false)
+        ORDER BY other.location <-> base.location  -- index knn, stops after limit
+        LIMIT {MAX_NUM_USERS_NEARBY * NEARBY_OVERSAMPLE}
+    ) AS knn
+    WHERE 
+        base.user_id = :user_id
+) AS ranked
+WHERE distance_km <= :max_distance
+ORDER BY distance_km
+LIMIT {MAX_NUM_USERS_NEARBY};
+""")
+
+# one batched upsert for one or many users.
+# prev: locations before this update (cte sees the pre-upsert snapshot), their cells go stale too.
+# conditional: a row with the same point, written within the heartbeat, is left as is (not returned)
+UPSERT_LOCATIONS_QUERY = text(f"""
+WITH new AS (
+    SELECT * FROM unnest(
+        CAST(:user_ids AS text[]), CAST(:latitudes AS float8[]),
+        CAST(:longitudes AS float8[]), CAST(:timestamps AS timestamptz[])
+    ) AS t(user_id, latitude, longitude, last_updated)
+),
+prev AS (
+    SELECT user_id, location FROM {LOCATIONS_TABLE_NAME} WHERE user_id IN (SELECT user_id FROM new)
+)
+INSERT INTO {LOCATIONS_TABLE_NAME} (user_id, location, last_updated)
+SELECT user_id, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography, last_updated FROM new
+ON CONFLICT (user_id) 
+DO UPDATE SET 
+    location = EXCLUDED.location,
+    last_updated = EXCLUDED.last_updated
+WHERE NOT COALESCE(
+    ST_Equals({LOCATIONS_TABLE_NAME}.location::geometry, EXCLUDED.location::geometry)
+    AND {LOCATIONS_TABLE_NAME}.last_updated
+        > EXCLUDED.last_updated - make_interval(secs => {LOCATION_HEARTBEAT_SECONDS}),
+    FALSE)
+RETURNING
+    user_id,
+    (SELECT ST_Y(prev.location::geometry) FROM prev WHERE prev.user_id = {LOCATIONS_TABLE_NAME}.user_id),
+    (SELECT ST_X(prev.location::geometry) FROM prev WHERE prev.user_id = {LOCATIONS_TABLE_NAME}.user_id)
+""")
+
+# unchanged point, heartbeat due: only last_updated (no indexed column changes, HOT update).
+# no row if the stored point differs (written by another worker meanwhile)
+TOUCH_LOCATION_QUERY = text(f"""
+UPDATE {LOCATIONS_TABLE_NAME} SET last_updated = :last_updated
+WHERE user_id = :user_id AND last_updated < :last_updated
+    AND ST_Equals(location::geometry, ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326))
+""")
+
+
+@app.get("/limiter/stats", dependencies=[serviceDep])
+def get_limiter_stats():
+    """admission control counters per route: allowed, limited (rate), shed (concurrency), in_flight"""
+    return admission_control.stats()
+
+
+@app.get("/locations/write_stats", dependencies=[serviceDep])
+def get_location_write_stats():
+    """location updates by outcome: write (moved), touch (heartbeat only), skip (no db write).
+    buffer_dropped: buffered updates rejected by the db"""
+    return {**last_positions.stats(), "buffer_dropped": location_buffer.dropped}
+
+
+@app.get("/profiler", dependencies=[serviceDep])
+def get_profiler():
+    return profiler.status()
+
+
+@app.post("/profiler", dependencies=[serviceDep])
+def configure_profiler(config: ProfilerConfig):
+    """toggle request profiling at runtime (this process only)"""
+    profiler.configure(config.enabled, config.sample_rate, config.routes)
+    return profiler.status()
+
+
+@app.get("/users", response_model=List[UserPoint])
 def get_all_users():
+    # json built by postgres, passed through as is
     with SessionLocal() as session:
-        query = text(f"""SELECT user_id, ST_AsText(location) AS point FROM {LOCATIONS_TABLE_NAME};""")
-        result = session.execute(query).fetchall()
-        users = [{"user_id": row[0], "point": row[1]} for row in result]
+        users = session.execute(ALL_USERS_QUERY).scalar()
 
-    return users
+    return raw_json_response(users)
+
+
+def _upsert_locations(rows: List[LocationRow]):
+    """one batched upsert for one or many users (one row per user)"""
+    with SessionLocal() as session:
+        user_ids, latitudes, longitudes, timestamps = zip(*rows)
+        changed = session.execute(UPSERT_LOCATIONS_QUERY, {
+            'user_ids': list(user_ids),
+            'latitudes': list(latitudes),
+            'longitudes': list(longitudes),
+            'timestamps': list(timestamps),
+        }).fetchall()
+        session.commit()
+
+    new = {row[0]: row for row in rows}
+    for user_id, prev_latitude, prev_longitude in changed:
+        _, latitude, longitude, _ = new[user_id]
+        if (prev_latitude, prev_longitude) == (latitude, longitude):
+            continue  # heartbeat only
+        nearby_cache.mark_dirty(latitude, longitude)
+        nearby_cache.mark_dirty(prev_latitude, prev_longitude)
+        cell_versions.bump(latitude, longitude)
+        cell_versions.bump(prev_latitude, prev_longitude)
+        density_grid.move(prev_latitude, prev_longitude, latitude, longitude)
+    for user_id, latitude, longitude, timestamp in rows:
+        last_positions.written(user_id, latitude, longitude, timestamp)
+
+
+def _touch_location(row: LocationRow) -> bool:
+    """False if the stored point is not the one this process last wrote"""
+    user_id, latitude, longitude, timestamp = row
+    with SessionLocal() as session:
+        touched = session.execute(TOUCH_LOCATION_QUERY, {
+            "user_id": user_id, "latitude": latitude, "longitude": longitude, "last_updated": timestamp,
+        }).rowcount
+        session.commit()
+    if touched:
+        last_positions.written(user_id, latitude, longitude, timestamp)
+    return bool(touched)
+
+
+location_buffer = LocationWriteBuffer(_upsert_locations)
 
 
 @app.post("/locations", tags=["Locations"])
@@ -45,100 +303,133 @@ def update_location(location: LocationUpdate, current_user: currUserDep):
     if location.user_id != current_user.user_id:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    with SessionLocal() as session:
-        stmt = text(f"""
-        INSERT INTO {LOCATIONS_TABLE_NAME} (user_id, location, last_updated)
-        VALUES (:user_id, ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326), :timestamp)
-        ON CONFLICT (user_id) 
-        DO UPDATE SET 
-            location = ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326),
-            last_updated = :timestamp
-        """)
-
-        session.execute(stmt, {
-            'user_id': location.user_id,
-            'latitude': location.latitude,
-            'longitude': location.longitude,
-            'timestamp': datetime.now(UTC)
-        })
-        session.commit()
+    row = (location.user_id, location.latitude, location.longitude, datetime.now(UTC))
+    action = last_positions.check(*row)
+    if action == SKIP:
+        return {"status": "unchanged", "latitude": location.latitude, "longitude": location.longitude}
+    location_history.add(row)  # queued, written in batches in the background
 
-        return {"status": "success", "latitude": location.latitude, "longitude": location.longitude}
+    if location_buffer.enabled:
+        location_buffer.add(row)  # the conditional upsert handles unchanged points
+        return {"status": "buffered", "latitude": location.latitude, "longitude": location.longitude}
+
+    if action == TOUCH and _touch_location(row):
+        return {"status": "unchanged", "latitude": location.latitude, "longitude": location.longitude}
+
+    _upsert_locations([row])
+    return {"status": "success", "latitude": location.latitude, "longitude": location.longitude}
 
 
 # TODO: improve
-@app.get("/locations/nearby_users", tags=["Locations"])
-def get_nearby_users(user_id: str, max_distance: float = 5.0, current_user: currUserDep = None) -> List[
-    Dict[str, object]]:
+@app.get("/locations/nearby_users", tags=["Locations"], response_model=List[NearbyUser])
+def get_nearby_users(request: Request, user_id: str,
+                     max_distance: float = Query(5.0, gt=0, le=MAX_NEARBY_DISTANCE_KM), adaptive: bool = False,
+                     precision: Literal["exact", "fast", "sphere"] = "exact", current_user: currUserDep = None):
+    """adaptive: search radius picked from the density grid to hold about MAX_NUM_USERS_NEARBY users
+    (max_distance is the upper bound).
+    precision: exact: spheroid distance of every candidate in the radius. fast: candidates in index knn order,
+    spheroid distance only for the first k * oversample (the k nearest may differ at the ~0.5% level).
+    sphere: as fast, with sphere distances (error < 0.6%, ~ 30 m at 5 km). adaptive implies at least fast.
+    conditional: If-None-Match with a current ETag is answered 304, without db query"""
     if current_user.user_id != user_id:
         raise HTTPException(status_code=403, detail="Forbidden")
 
+    etag_key = f"{user_id}|{max_distance}|{adaptive}|{precision}"
+    etag = cell_versions.match(request.headers.get("if-none-match"), max_distance, etag_key)
+    if etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # the cache holds exact (spheroid) k nearest within max_distance
+    cached = nearby_cache.get(user_id, max_distance) if not adaptive and precision == "exact" else None
+    if cached is not None:
+        return json_response([_nearby_user(n["user_id"], n["distance_km"], n["latitude"], n["longitude"])
+                              for n in cached])
+
     with SessionLocal() as session:
         # check exists
-        query = text(f"SELECT EXISTS(SELECT 1 FROM {LOCATIONS_TABLE_NAME} WHERE user_id = :user_id)")
-        result = session.execute(query, {"user_id": user_id }).scalar()
-        if not result:
+        base = session.execute(USER_POINT_QUERY, {"user_id": user_id}).first()
+        if not base:
             raise HTTPException(status_code=404, detail="User not found")
+        # before the query: a write landing meanwhile changes the next tag. cached results get no tag,
+        # they may be older than the counters
+        etag = cell_versions.etag(base[0], base[1], max_distance, etag_key)
 
-        query = text(f"""
-        SELECT
-            other.user_id,
-            ST_Distance(other.location::geography, base.location::geography) / 1000 as distance_km,
-            ST_X(other.location) as longitude, ST_Y(other.location) as latitude
-        FROM 
-            {LOCATIONS_TABLE_NAME} AS base
-        JOIN 
-            {LOCATIONS_TABLE_NAME} AS other ON other.user_id != base.user_id
-        WHERE 
-            base.user_id = :user_id
-            AND ST_DWithin(
-                other.location::geography, -- geography cast for accurate distance calculation
-                base.location::geography,
-                :max_distance * 1000  -- meters
-            )
-        ORDER BY distance_km
-        LIMIT {MAX_NUM_USERS_NEARBY};
-        """)
-
+        if adaptive:
+            max_distance = density_grid.effective_radius(base[0], base[1], MAX_NUM_USERS_NEARBY, max_distance)
+        query = NEARBY_QUERY if precision == "exact" and not adaptive else NEARBY_KNN_QUERY
         result = session.execute(query, {
             'user_id': user_id,
             'max_distance': max_distance,
+            'spheroid': precision != "sphere",
         })
 
-        nearby_users = [
-            {
-                "user_id": row[0],
-                "distance": round(row[1], 2),
-                "location": {"latitude": row[3], "longitude": row[2]}
-            }
-            for row in result
-        ]
+        nearby_users = [_nearby_user(row[0], row[1], row[3], row[2]) for row in result]
 
-        return nearby_users
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else None
+        return json_response(nearby_users, headers=headers)
 
 
-def insert_initial_users():
-    # get all usernames, add password to missing users
-    sample_user_ids = []
-    for line in DB_LONDON_VALUES.strip().splitlines():
-        u = line.split(",")[0].strip("'")
-        u = u.replace("('", "").strip()
-        if u:
-            sample_user_ids.append(u)
+@app.get("/density/tiles/{zoom}/{x}/{y}", tags=["Density"])
+def get_density_tile(zoom: int, x: int, y: int, detail: int = Query(4, ge=0, le=MAX_TILE_DETAIL)):
+    """user count per sub tile of web mercator tile zoom/x/y, detail levels deeper (4: 16 x 16 sub tiles),
+    from the in-memory pre-aggregate (DENSITY_GRID=1), no point scan. cells: [[x, y, count], ...] at cell_zoom"""
+    if not density_grid.enabled:
+        raise HTTPException(status_code=503, detail="Density grid disabled")
+    if not (0 <= zoom <= density_grid.max_zoom and 0 <= x < 1 << zoom and 0 <= y < 1 << zoom):
+        raise HTTPException(status_code=404, detail="Tile not found")
 
-    log.info(f"insert {sample_user_ids} {len(sample_user_ids)} initial users")
-    with SessionLocal() as session:
-        q = text(f"""SELECT user_id FROM {USERS_TABLE_NAME};""")
-        result = session.execute(q)
-        user_ids_with_pw = [row.user_id for row in result]
-        for user_id in sample_user_ids:
-            if user_id not in user_ids_with_pw:
-                create_initial_user(user_id=user_id, password="secret", session=session)
-        session.commit()
+    cells = density_grid.tile_counts(zoom, x, y, detail)
+    return json_response({"zoom": zoom, "x": x, "y": y, "cell_zoom": zoom + min(detail, density_grid.max_zoom - zoom),
+                          "cells": cells}, headers={"Cache-Control": "public, max-age=60"})
+
+
+@app.post("/locations/nearby_users/batch", tags=["Locations"], dependencies=[serviceDep])
+def get_nearby_users_batch(request: NearbyBatchRequest):
+    """nearby users for many users (service token), one LATERAL knn join.
+    streams one json line per requested user: {"user_id", "nearby_users"} or {"user_id", "error"}"""
+    query = text(f"""
+    SELECT base.user_id AS base_user_id, n.user_id, n.distance_km, n.longitude, n.latitude
+    FROM 
+        {LOCATIONS_TABLE_NAME} AS base
+    LEFT JOIN LATERAL (
+        SELECT
+            other.user_id,
+            ST_Distance(other.location, base.location) / 1000 AS distance_km,
+            ST_X(other.location::geometry) AS longitude, ST_Y(other.location::geometry) AS latitude
+        FROM {LOCATIONS_TABLE_NAME} AS other
+        WHERE other.user_id != base.user_id
+            AND ST_DWithin(other.location, base.location, :max_distance * 1000)
+        ORDER BY other.location <-> base.location  -- index knn
+        LIMIT {MAX_NUM_USERS_NEARBY}
+    ) AS n ON TRUE
+    WHERE base.user_id = ANY(:user_ids)
+    ORDER BY base.user_id, n.distance_km;
+    """)
+    user_ids = list(dict.fromkeys(request.user_ids))
+
+    def generate():
+        found = set()
+        with SessionLocal() as session:
+            result = session.execute(query.execution_options(stream_results=True, yield_per=1000), {
+                'user_ids': user_ids,
+                'max_distance': request.max_distance,
+            })
+            for base_user_id, rows in groupby(result, key=lambda row: row.base_user_id):
+                found.add(base_user_id)
+                nearby_users = [_nearby_user(r.user_id, r.distance_km, r.latitude, r.longitude)
+                                for r in rows if r.user_id is not None]
+                yield orjson.dumps({"user_id": base_user_id, "nearby_users": nearby_users}) + b"\n"
+
+        for user_id in user_ids:
+            if user_id not in found:
+                yield orjson.dumps({"user_id": user_id, "error": "User not found"}) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
-    init_db()
-    insert_initial_users()
-    insert_location_data()
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    migrate()  # warm start: one version check. seed sample data with: python seed.py
+    log.info(f"serve on port {PORT} with {WORKERS} worker(s), debug={DEBUG}, log level {LOG_LEVEL}")
+    # workers > 1 needs the app as import string, each worker process imports it
+    uvicorn.run("main:app" if WORKERS > 1 else app, host="0.0.0.0", port=PORT, workers=WORKERS,
+                loop="uvloop", http="httptools", log_level=LOG_LEVEL.lower())
@@ -0,0 +1,139 @@
+"""
+online migration of user_locations.location from geometry(Point,4326) to native geography(Point,4326).
+
+1. add a shadow geography column, kept in sync for new writes by a trigger
+2. backfill existing rows in small batches (short transactions, no long table lock)
+3. build the GiST index on the shadow column concurrently
+4. swap: drop the geometry column (and its indexes), rename the shadow column and index
+
+steps 1-3 are safe while any app version serves. the swap is not for an app that reads the column as
+geometry (e.g. ST_X(location)): geography has no implicit cast to geometry, those queries fail after it.
+order: deploy the app version with explicit location::geometry casts (they work on both column types) first,
+then run the migration (it also runs on that version's start).
+
+usage: python migrate_geography.py [--batch-size N] [--pause SECONDS]
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import text
+
+from db_ import engine, LOCATIONS_TABLE_NAME
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+NEW_COLUMN = "location_geog"
+SYNC_FUNCTION = f"{LOCATIONS_TABLE_NAME}_sync_geog"
+NEW_INDEX = f"idx_{LOCATIONS_TABLE_NAME}_{NEW_COLUMN}"
+FINAL_INDEX = f"idx_{LOCATIONS_TABLE_NAME}_geography"
+
+
+def location_column_type() -> str | None:
+    """'geometry', 'geography' or None if table doesn't exist yet"""
+    with engine.connect() as conn:
+        q = text("""
+        SELECT udt_name FROM information_schema.columns
+        WHERE table_name = :table_name AND column_name = 'location'
+        """)
+        return conn.execute(q, {"table_name": LOCATIONS_TABLE_NAME}).scalar()
+
+
+def _add_shadow_column():
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+        ALTER TABLE {LOCATIONS_TABLE_NAME} ADD COLUMN IF NOT EXISTS {NEW_COLUMN} geography(Point, 4326);
+        """))
+        # writes from the old app keep filling the shadow column while we backfill
+        conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION {SYNC_FUNCTION}() RETURNS trigger AS $$
+        BEGIN
+            NEW.{NEW_COLUMN} := NEW.location::geography;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """))
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {SYNC_FUNCTION} ON {LOCATIONS_TABLE_NAME};"))
+        conn.execute(text(f"""
+        CREATE TRIGGER {SYNC_FUNCTION} BEFORE INSERT OR UPDATE OF location ON {LOCATIONS_TABLE_NAME}
+        FOR EACH ROW EXECUTE FUNCTION {SYNC_FUNCTION}();
+        """))
+        conn.commit()
+
+
+def _backfill(batch_size: int, pause: float) -> int:
+    """copy location -> shadow column, one short transaction per batch"""
+    q = text(f"""
+    UPDATE {LOCATIONS_TABLE_NAME} SET {NEW_COLUMN} = location::geography
+    WHERE user_id IN (
+        SELECT user_id FROM {LOCATIONS_TABLE_NAME}
+        WHERE {NEW_COLUMN} IS NULL AND location IS NOT NULL
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    """)
+    total = 0
+    while True:
+        with engine.connect() as conn:
+            n = conn.execute(q, {"batch_size": batch_size}).rowcount
+            conn.commit()
+        total += n
+        if n:
+            log.info(f"backfilled {total} rows")
+        if n < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def _create_shadow_index():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS {NEW_INDEX}
+        ON {LOCATIONS_TABLE_NAME} USING GIST ({NEW_COLUMN});
+        """))
+
+
+def _swap():
+    """short exclusive lock: catch up stragglers, drop geometry column (and its indexes), rename"""
+    with engine.connect() as conn:
+        conn.execute(text(f"LOCK TABLE {LOCATIONS_TABLE_NAME} IN ACCESS EXCLUSIVE MODE;"))
+        conn.execute(text(f"""
+        UPDATE {LOCATIONS_TABLE_NAME} SET {NEW_COLUMN} = location::geography
+        WHERE {NEW_COLUMN} IS NULL AND location IS NOT NULL;
+        """))
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {SYNC_FUNCTION} ON {LOCATIONS_TABLE_NAME};"))
+        conn.execute(text(f"DROP FUNCTION IF EXISTS {SYNC_FUNCTION}();"))
+        conn.execute(text(f"ALTER TABLE {LOCATIONS_TABLE_NAME} DROP COLUMN location;"))
+        conn.execute(text(f"ALTER TABLE {LOCATIONS_TABLE_NAME} RENAME COLUMN {NEW_COLUMN} TO location;"))
+        conn.execute(text(f"ALTER INDEX {NEW_INDEX} RENAME TO {FINAL_INDEX};"))
+        conn.commit()
+
+
+def migrate_location_to_geography(batch_size: int = BATCH_SIZE, pause: float = 0.0) -> bool:
+    """migrate if needed. returns True if a migration was performed"""
+    column_type = location_column_type()
+    if column_type != "geometry":
+        log.info(f"{LOCATIONS_TABLE_NAME}.location is {column_type}, nothing to migrate")
+        return False
+
+    log.info(f"migrate {LOCATIONS_TABLE_NAME}.location to geography (batch size {batch_size})")
+    _add_shadow_column()
+    n = _backfill(batch_size, pause)
+    log.info(f"backfill done ({n} rows), create index {NEW_INDEX}")
+    _create_shadow_index()
+    _swap()
+    log.info(f"{LOCATIONS_TABLE_NAME}.location migrated to geography")
+    return True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    migrate_location_to_geography(batch_size=args.batch_size, pause=args.pause)
@@ -0,0 +1,81 @@
+"""
+schema versioning. a warm start only reads the version row in schema_version.
+pending migrations run in order, under the init advisory lock (one replica at a time).
+new schema changes: append a step to MIGRATIONS, never edit or reorder existing ones.
+
+usage: python migrations.py
+"""
+import logging
+import time
+from typing import Callable, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from db_ import engine, init_lock, create_base_schema, add_nearby_cache_computed_at_index, add_user_revocation_columns
+from location_history import create_location_history
+from migrate_geography import migrate_location_to_geography
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE_NAME = "schema_version"
+
+# step i brings the schema to version i + 1
+MIGRATIONS: List[Tuple[str, Callable[[], object]]] = [
+    ("postgis, tables, spatial indexes", create_base_schema),
+    ("user_locations.location as geography", migrate_location_to_geography),
+    ("users.tokens_valid_after, users.updated_at", add_user_revocation_columns),
+    ("location_history, partitioned by day", create_location_history),
+    ("nearby_cache.computed_at index", add_nearby_cache_computed_at_index),
+]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def current_version() -> int:
+    """0 if the db was never versioned. retries while the db is starting"""
+    num_attempts = 3
+    sleep_time = 3
+    for i in range(num_attempts):
+        try:
+            with engine.connect() as conn:
+                return conn.execute(text(f"SELECT version FROM {SCHEMA_VERSION_TABLE_NAME}")).scalar() or 0
+        except ProgrammingError:  # no version table yet
+            return 0
+        except OperationalError as e:
+            if i == num_attempts - 1:
+                log.error(f"Error connecting to db: {e}")
+                raise e
+            log.info(f"sleep {sleep_time}s before retry db engine.connect()")
+            time.sleep(sleep_time)
+
+
+def _set_version(version: int):
+    with engine.connect() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE_NAME} (version integer NOT NULL)"))
+        conn.execute(text(f"DELETE FROM {SCHEMA_VERSION_TABLE_NAME}"))
+        conn.execute(text(f"INSERT INTO {SCHEMA_VERSION_TABLE_NAME} (version) VALUES (:version)"),
+                     {"version": version})
+        conn.commit()
+
+
+def migrate() -> int:
+    """bring schema to LATEST_VERSION. returns the version"""
+    version = current_version()
+    if version >= LATEST_VERSION:
+        log.debug(f"schema version {version}, up to date")
+        return version
+
+    with init_lock():
+        version = current_version()  # another replica may have migrated while we waited
+        for v in range(version + 1, LATEST_VERSION + 1):
+            description, step = MIGRATIONS[v - 1]
+            log.info(f"schema migration {v}/{LATEST_VERSION}: {description}")
+            step()
+            _set_version(v)
+    return LATEST_VERSION
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
+    migrate()
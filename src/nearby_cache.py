@@ -0,0 +1,228 @@
+"""
+precomputed top-k nearby users (table nearby_cache), refreshed by a background thread.
+
+one row per user holds its k nearest neighbours within NEARBY_CACHE_RADIUS_KM, so any request with
+max_distance <= radius is answered by a primary-key lookup + filter on distance
+(the k nearest within a smaller radius are a prefix of the k nearest within the larger one).
+
+rows are recomputed by a bulk spatial self-join, in batches:
+- users near grid cells that saw update_location writes (dirty cells), every refresh interval.
+  new users come in this way: their first write marks their cell
+- stale rows (e.g. writes handled by another process), oldest first via the computed_at index, sized so every
+  row is refreshed once per max age / 2. rows not refreshed in time expire (max age) and those requests fall back
+  to the live query
+- missing rows (users that did not write since the cache was enabled), once per process start
+one process refreshes at a time (advisory lock); the others keep their dirty cells for a later interval.
+"""
+import logging
+import math
+import os
+import threading
+from typing import List, Dict, Set, Tuple
+
+from sqlalchemy import text
+
+from db_ import engine, SessionLocal, INIT_LOCK_ID, LOCATIONS_TABLE_NAME, NEARBY_CACHE_TABLE_NAME
+
+log = logging.getLogger(__name__)
+
+NEARBY_CACHE_ENABLED = os.getenv("NEARBY_CACHE", "0") == "1"
+NEARBY_CACHE_RADIUS_KM = float(os.getenv("NEARBY_CACHE_RADIUS_KM", 10.0))
+NEARBY_CACHE_MAX_AGE_SECONDS = float(os.getenv("NEARBY_CACHE_MAX_AGE_SECONDS", 60))
+REFRESH_INTERVAL_SECONDS = 2.0
+REFRESH_BATCH_SIZE = 500
+CELL_SIZE_DEG = 0.05
+REFRESH_LOCK_ID = INIT_LOCK_ID + 2  # one replica at a time
+
+Cell = Tuple[int, int]
+
+
+def cell_of(latitude: float, longitude: float) -> Cell:
+    return math.floor(latitude / CELL_SIZE_DEG), math.floor(longitude / CELL_SIZE_DEG)
+
+
+class NearbyCache:
+    def __init__(self, k: int, radius_km: float = NEARBY_CACHE_RADIUS_KM,
+                 max_age_seconds: float = NEARBY_CACHE_MAX_AGE_SECONDS, enabled: bool = NEARBY_CACHE_ENABLED):
+        self.k = k
+        self.radius_km = radius_km
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self._dirty_cells: Set[Cell] = set()
+        self._backfilled = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # read path
+    def get(self, user_id: str, max_distance: float) -> List[Dict] | None:
+        """cached neighbours within max_distance, or None if not cached / too old / radius not covered"""
+        if not self.enabled or max_distance > self.radius_km:
+            return None
+
+        with SessionLocal() as session:
+            q = text(f"""
+            SELECT neighbours FROM {NEARBY_CACHE_TABLE_NAME}
+            WHERE user_id = :user_id AND computed_at >= NOW() - make_interval(secs => :max_age)
+            """)
+            neighbours = session.execute(q, {"user_id": user_id, "max_age": self.max_age_seconds}).scalar()
+
+        if neighbours is None:
+            return None
+        return [n for n in neighbours if n["distance_km"] <= max_distance]
+
+    # write path
+    def mark_dirty(self, latitude: float | None, longitude: float | None):
+        if not self.enabled or latitude is None or longitude is None:
+            return
+        with self._lock:
+            self._dirty_cells.add(cell_of(latitude, longitude))
+
+    # refresh
+    def refresh(self, user_ids: List[str]) -> int:
+        """recompute rows for user_ids with one bulk self-join per batch"""
+        q = text(f"""
+        INSERT INTO {NEARBY_CACHE_TABLE_NAME} (user_id, neighbours, computed_at)
+        SELECT base.user_id, COALESCE(n.neighbours, '[]'::jsonb), NOW()
+        FROM {LOCATIONS_TABLE_NAME} AS base
+        LEFT JOIN LATERAL (
+            SELECT jsonb_agg(jsonb_build_object(
+                'user_id', c.user_id, 'distance_km', c.distance_km,
+                'latitude', c.latitude, 'longitude', c.longitude) ORDER BY c.distance_km) AS neighbours
+            FROM (
+                SELECT
+                    other.user_id,
+                    ST_Distance(other.location, base.location) / 1000 AS distance_km,
+                    ST_Y(other.location::geometry) AS latitude, ST_X(other.location::geometry) AS longitude
+                FROM {LOCATIONS_TABLE_NAME} AS other
+                WHERE other.user_id != base.user_id
+                    AND ST_DWithin(other.location, base.location, :radius_km * 1000)
+                ORDER BY distance_km
+                LIMIT :k
+            ) AS c
+        ) AS n ON TRUE
+        WHERE base.user_id = ANY(:user_ids) AND base.location IS NOT NULL
+        ON CONFLICT (user_id)
+        DO UPDATE SET
+            neighbours = EXCLUDED.neighbours,
+            computed_at = EXCLUDED.computed_at
+        """)
+
+        n = 0
+        for i in range(0, len(user_ids), REFRESH_BATCH_SIZE):
+            batch = user_ids[i:i + REFRESH_BATCH_SIZE]
+            with SessionLocal() as session:
+                session.execute(q, {"user_ids": batch, "radius_km": self.radius_km, "k": self.k})
+                session.commit()
+            n += len(batch)
+        return n
+
+    def refresh_dirty(self) -> int:
+        """recompute rows of users within radius of any cell written to since last refresh"""
+        with self._lock:
+            cells, self._dirty_cells = self._dirty_cells, set()
+        if not cells:
+            return 0
+
+        q = text(f"""
+        SELECT user_id FROM {LOCATIONS_TABLE_NAME}
+        WHERE ST_DWithin(
+            location,
+            ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)::geography,
+            :radius_km * 1000
+        )
+        """)
+        user_ids = set()
+        with SessionLocal() as session:
+            for lat_i, lon_i in cells:
+                result = session.execute(q, {
+                    "min_lat": lat_i * CELL_SIZE_DEG, "max_lat": (lat_i + 1) * CELL_SIZE_DEG,
+                    "min_lon": lon_i * CELL_SIZE_DEG, "max_lon": (lon_i + 1) * CELL_SIZE_DEG,
+                    "radius_km": self.radius_km,
+                })
+                user_ids.update(row[0] for row in result)
+
+        n = self.refresh(sorted(user_ids))
+        log.debug(f"refreshed {n} nearby_cache rows for {len(cells)} dirty cells")
+        return n
+
+    def stale_batch_size(self, n_rows: float) -> int:
+        """rows per refresh interval to refresh every row once per max age / 2"""
+        return max(REFRESH_BATCH_SIZE, math.ceil(n_rows * REFRESH_INTERVAL_SECONDS / (self.max_age_seconds / 2)))
+
+    def refresh_stale(self, limit: int | None = None) -> int:
+        """recompute up to limit rows about to exceed max age, oldest first (index scan on computed_at).
+        limit: from the table size estimate by default"""
+        q = text(f"""
+        SELECT user_id FROM {NEARBY_CACHE_TABLE_NAME}
+        WHERE computed_at < NOW() - make_interval(secs => :age)
+        ORDER BY computed_at
+        LIMIT :limit
+        """)
+        with SessionLocal() as session:
+            if limit is None:
+                n_rows = session.execute(text("SELECT reltuples FROM pg_class WHERE relname = :table"),
+                                         {"table": NEARBY_CACHE_TABLE_NAME}).scalar()
+                limit = self.stale_batch_size(max(n_rows or 0, 0))  # -1: never analyzed
+            user_ids = [row[0] for row in session.execute(q, {"age": self.max_age_seconds / 2, "limit": limit})]
+
+        n = self.refresh(user_ids)
+        if n:
+            log.debug(f"refreshed {n} stale nearby_cache rows")
+        return n
+
+    def refresh_missing(self) -> int:
+        """rows for users without one (one full anti-join, at start)"""
+        q = text(f"""
+        SELECT loc.user_id FROM {LOCATIONS_TABLE_NAME} AS loc
+        WHERE loc.location IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM {NEARBY_CACHE_TABLE_NAME} AS cache WHERE cache.user_id = loc.user_id)
+        """)
+        with SessionLocal() as session:
+            user_ids = [row[0] for row in session.execute(q)]
+
+        n = self.refresh(user_ids)
+        log.info(f"filled {n} missing nearby_cache rows")
+        return n
+
+    # background job
+    def refresh_locked(self):
+        """dirty and stale refresh, skipped while another process holds the refresh lock"""
+        with engine.connect() as conn:
+            if not conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": REFRESH_LOCK_ID}).scalar():
+                log.debug(f"nearby_cache refresh running elsewhere")
+                conn.rollback()
+                return
+            conn.commit()  # session level lock, not idle in transaction during the refresh
+            try:
+                if not self._backfilled:
+                    self.refresh_missing()
+                    self._backfilled = True
+                self.refresh_dirty()
+                self.refresh_stale()
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": REFRESH_LOCK_ID})
+                conn.commit()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_locked()
+            except Exception as e:
+                log.error(f"nearby_cache refresh failed: {e}")
+            self._stop.wait(REFRESH_INTERVAL_SECONDS)
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        log.info(f"start nearby_cache refresh (k={self.k}, radius={self.radius_km}km)")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="nearby-cache-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,218 @@
+"""
+query plan regression check for the spatial statements of main.py.
+seeds a scratch copy of user_locations (same columns and indexes) at several sizes and densities,
+runs EXPLAIN (ANALYZE, BUFFERS) per statement and checks:
+- the gist index is used where required (no silent seq scan fallback on the geography self-join)
+- rows read and shared buffers stay within budget
+plans and timings are written as json artifacts. everything runs in a rolled back transaction.
+exit code 1 on any violation.
+
+usage: python plan_check.py [--sizes 10000 100000] [--densities uniform dense] [--out plan_artifacts]
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+from datetime import datetime, UTC
+from typing import Any, Callable, Dict, Iterator, List
+
+from sqlalchemy import text
+
+from db_ import engine, LOCATIONS_TABLE_NAME
+from main import (MAX_NUM_USERS_NEARBY, ALL_USERS_QUERY, NEARBY_KNN_QUERY, NEARBY_QUERY, UPSERT_LOCATIONS_QUERY,
+                  USER_POINT_QUERY)
+from migrations import migrate
+
+log = logging.getLogger(__name__)
+
+SCRATCH_SCHEMA = "plan_check"
+CENTER = (51.5074, -0.1278)  # london
+BASE_USER_ID = "plan_0"  # requester of the nearby queries, at the center
+UPSERT_BATCH = 1000
+NEARBY_RADIUS_KM = 5.0
+KM_PER_DEG = 111.32
+UNIFORM_SPAN_DEG = (0.6, 1.0)  # lat, lon
+DENSE_SIGMA_DEG = (0.01, 0.015)
+
+# point generators (sql, lat/lon of row g): uniform over greater london, or a ~1 km gaussian around the center
+DENSITIES = {
+    "uniform": (f"{{lat}} + (random() - 0.5) * {UNIFORM_SPAN_DEG[0]}",
+                f"{{lon}} + (random() - 0.5) * {UNIFORM_SPAN_DEG[1]}"),
+    "dense": (f"{{lat}} + {DENSE_SIGMA_DEG[0]} * sqrt(-2 * ln(1 - random())) * cos(2 * pi() * random())",
+              f"{{lon}} + {DENSE_SIGMA_DEG[1]} * sqrt(-2 * ln(1 - random())) * cos(2 * pi() * random())"),
+}
+
+Budget = Callable[[int, str], int]  # table size, density -> limit
+
+
+def expected_within(size: int, density: str, radius_km: float = NEARBY_RADIUS_KM) -> float:
+    """expected seeded users within radius_km of the center: the result set a nearby plan has to read"""
+    km_lat, km_lon = KM_PER_DEG, KM_PER_DEG * math.cos(math.radians(CENTER[0]))
+    if density == "uniform":
+        return size * min(1.0, math.pi * radius_km ** 2 / (UNIFORM_SPAN_DEG[0] * km_lat * UNIFORM_SPAN_DEG[1] * km_lon))
+    sigma_km = math.sqrt(DENSE_SIGMA_DEG[0] * km_lat * DENSE_SIGMA_DEG[1] * km_lon)
+    return size * (1 - math.exp(-radius_km ** 2 / (2 * sigma_km ** 2)))  # rayleigh cdf
+
+
+def _nearby_budget(per_row: int, constant: int) -> Budget:
+    """the index reads the radius' bounding box (4/pi of the circle) and rechecks: 2x the result set,
+    not a multiple of the table size (a plan reading all rows through the gist index must fail)"""
+    return lambda n, density: int(per_row * expected_within(n, density)) + constant
+
+
+class Check:
+    def __init__(self, query, params: Callable[[int], Dict[str, Any]], gist: bool, seq_scan: bool,
+                 max_rows: Budget, max_buffers: Budget):
+        """gist: must use a gist index. seq_scan: seq scan on user_locations allowed.
+        max_rows: rows read by all scans (incl. filtered out, times loops). max_buffers: shared hit + read.
+        budgets are functions of the table size and the seeded density"""
+        self.query = query
+        self.params = params
+        self.gist = gist
+        self.seq_scan = seq_scan
+        self.max_rows = max_rows
+        self.max_buffers = max_buffers
+
+
+def _upsert_params(n_rows: int) -> Callable[[int], Dict[str, Any]]:
+    def params(size: int) -> Dict[str, Any]:
+        user_ids = [f"plan_{i}" for i in random.sample(range(1, size + 1), min(n_rows, size))]
+        return {
+            "user_ids": user_ids,
+            "latitudes": [CENTER[0] + random.uniform(-0.05, 0.05) for _ in user_ids],
+            "longitudes": [CENTER[1] + random.uniform(-0.05, 0.05) for _ in user_ids],
+            "timestamps": [datetime.now(UTC)] * len(user_ids),
+        }
+    return params
+
+
+# budgets are loose: they catch plan shape regressions (nested loop over all rows, seq scan), not noise
+CHECKS: Dict[str, Check] = {
+    "user_point": Check(USER_POINT_QUERY, lambda n: {"user_id": BASE_USER_ID},
+                        gist=False, seq_scan=False, max_rows=lambda n, d: 10, max_buffers=lambda n, d: 50),
+    "nearby": Check(NEARBY_QUERY, lambda n: {"user_id": BASE_USER_ID, "max_distance": NEARBY_RADIUS_KM},
+                    gist=True, seq_scan=False, max_rows=_nearby_budget(2, 100), max_buffers=_nearby_budget(2, 1000)),
+    "nearby_knn": Check(NEARBY_KNN_QUERY,
+                        lambda n: {"user_id": BASE_USER_ID, "max_distance": NEARBY_RADIUS_KM, "spheroid": True},
+                        gist=True, seq_scan=False, max_rows=lambda n, d: 20 * MAX_NUM_USERS_NEARBY,
+                        max_buffers=lambda n, d: 1000),
+    "users": Check(ALL_USERS_QUERY, lambda n: {},
+                   gist=False, seq_scan=True, max_rows=lambda n, d: n + 1, max_buffers=lambda n, d: n // 10 + 1000),
+    "upsert": Check(UPSERT_LOCATIONS_QUERY, _upsert_params(1),
+                    gist=False, seq_scan=False, max_rows=lambda n, d: 100, max_buffers=lambda n, d: 200),
+    # planner may pick a hash join + seq scan for the batch's prev lookup on small tables, only budgets
+    f"upsert_{UPSERT_BATCH}": Check(UPSERT_LOCATIONS_QUERY, _upsert_params(UPSERT_BATCH),
+                                    gist=False, seq_scan=True, max_rows=lambda n, d: 20 * UPSERT_BATCH + n,
+                                    max_buffers=lambda n, d: 50 * UPSERT_BATCH + n // 10),
+}
+
+
+def _nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+def plan_metrics(explain: Dict[str, Any], gist_indexes: List[str]) -> Dict[str, Any]:
+    plan = explain["Plan"]
+    nodes = list(_nodes(plan))
+    scans = [node for node in nodes if "Relation Name" in node or "Index Name" in node]
+    return {
+        "planning_ms": explain.get("Planning Time"),
+        "execution_ms": explain.get("Execution Time"),
+        "buffers": plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0),
+        "rows_read": sum((node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)
+                          + node.get("Rows Removed by Index Recheck", 0)) * node.get("Actual Loops", 1)
+                         for node in scans),
+        "indexes": sorted({node["Index Name"] for node in nodes if "Index Name" in node}),
+        "gist_used": any(node.get("Index Name") in gist_indexes for node in nodes),
+        "seq_scans": sum(node["Node Type"] == "Seq Scan" and node.get("Relation Name") == LOCATIONS_TABLE_NAME
+                         for node in nodes),
+    }
+
+
+def violations(check: Check, metrics: Dict[str, Any], size: int, density: str) -> List[str]:
+    found = []
+    max_rows, max_buffers = check.max_rows(size, density), check.max_buffers(size, density)
+    if check.gist and not metrics["gist_used"]:
+        found.append(f"gist index not used (indexes: {metrics['indexes']})")
+    if not check.seq_scan and metrics["seq_scans"]:
+        found.append(f"{metrics['seq_scans']} seq scan(s) on {LOCATIONS_TABLE_NAME}")
+    if metrics["rows_read"] > max_rows:
+        found.append(f"rows read {metrics['rows_read']} > budget {max_rows}")
+    if metrics["buffers"] > max_buffers:
+        found.append(f"buffers {metrics['buffers']} > budget {max_buffers}")
+    return found
+
+
+def _seed(conn, size: int, density: str):
+    """scratch user_locations shadowing the real one (search_path), same columns and indexes"""
+    conn.execute(text(f"CREATE SCHEMA {SCRATCH_SCHEMA}"))
+    conn.execute(text(f"CREATE TABLE {SCRATCH_SCHEMA}.{LOCATIONS_TABLE_NAME} "
+                      f"(LIKE {LOCATIONS_TABLE_NAME} INCLUDING ALL)"))
+    conn.execute(text(f"SET LOCAL search_path TO {SCRATCH_SCHEMA}, public"))
+
+    lat, lon = (expr.format(lat=CENTER[0], lon=CENTER[1]) for expr in DENSITIES[density])
+    conn.execute(text(f"""
+    INSERT INTO {LOCATIONS_TABLE_NAME} (user_id, location, last_updated)
+    SELECT 'plan_' || g, ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326)::geography, now()
+    FROM generate_series(1, :size) AS g
+    UNION ALL
+    SELECT :base_user_id, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography, now()
+    """), {"size": size, "base_user_id": BASE_USER_ID, "lat": CENTER[0], "lon": CENTER[1]})
+    conn.execute(text(f"ANALYZE {LOCATIONS_TABLE_NAME}"))
+
+
+def run_case(size: int, density: str, out_dir: str) -> List[Dict[str, Any]]:
+    results = []
+    with engine.connect() as conn:
+        try:
+            _seed(conn, size, density)
+            gist_indexes = list(conn.execute(text("""
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = :schema AND tablename = :table AND indexdef ILIKE '%USING gist%'
+            """), {"schema": SCRATCH_SCHEMA, "table": LOCATIONS_TABLE_NAME}).scalars())
+
+            for name, check in CHECKS.items():
+                explain = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + check.query.text),
+                                       check.params(size)).scalar()[0]
+                metrics = plan_metrics(explain, gist_indexes)
+                result = {"statement": name, "size": size, "density": density, **metrics,
+                          "violations": violations(check, metrics, size, density)}
+                results.append(result)
+
+                with open(os.path.join(out_dir, f"{density}_{size}_{name}.json"), "w") as f:
+                    json.dump({**result, "plan": explain}, f, indent=2)
+                level = logging.ERROR if result["violations"] else logging.INFO
+                log.log(level, f"{density:<8} {size:>9,} {name:<12} {metrics['execution_ms']:9.2f} ms "
+                               f"rows {metrics['rows_read']:>9,} buffers {metrics['buffers']:>9,} "
+                               f"{'; '.join(result['violations']) or 'ok'}")
+        finally:
+            conn.rollback()  # drops the scratch schema and upserted rows
+    return results
+
+
+def main(sizes: List[int], densities: List[str], out_dir: str) -> int:
+    migrate()  # real table and indexes, copied by the scratch table
+    os.makedirs(out_dir, exist_ok=True)
+    results = [result for size in sizes for density in densities for result in run_case(size, density, out_dir)]
+    with open(os.path.join(out_dir, "summary.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    failed = [r for r in results if r["violations"]]
+    log.info(f"{len(results) - len(failed)}/{len(results)} plans ok, artifacts in {out_dir}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--densities", nargs="+", choices=list(DENSITIES), default=list(DENSITIES))
+    parser.add_argument("--out", default="plan_artifacts")
+    args = parser.parse_args()
+    sys.exit(main(args.sizes, args.densities, args.out))
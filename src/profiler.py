@@ -0,0 +1,188 @@
+"""
+sampled request profiling (http middleware), off by default, toggled at runtime via POST /profiler.
+
+a profiled request is picked by PROFILE_SAMPLE_RATE, by route (PROFILE_ROUTES) or by the header
+"X-Profile: <service token>" (ignored without a valid one).
+while it is in flight a sampler thread records the python stacks of all busy threads every PROFILE_INTERVAL_MS
+(event loop: middleware, async dependencies like get_current_user; threadpool: sync handlers, sql, serialization).
+one collapsed-stack file per request ("frame;frame;frame count" lines, wall clock) in PROFILE_DIR,
+loadable by flamegraph.pl or speedscope, written by the sampler thread (no file io on the event loop).
+frames are module:function, with the line number if PROFILE_LINES=1.
+at most PROFILE_MAX_FILES files are kept, the oldest are deleted.
+stacks are process wide: with concurrent requests they include the other requests' threads too.
+"""
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, UTC
+from typing import Dict, List, Tuple
+
+from fastapi import Request
+
+from sec import is_service_token
+
+log = logging.getLogger(__name__)
+
+PROFILE_ENABLED = os.getenv("PROFILE", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.01))  # fraction of requests
+PROFILE_ROUTES = [r for r in os.getenv("PROFILE_ROUTES", "").split(",") if r]  # paths always profiled
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_LINES = os.getenv("PROFILE_LINES", "0") == "1"  # line numbers split a function into one frame per call site
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 1000))
+PROFILE_HEADER = "x-profile"
+MAX_STACK_DEPTH = 128
+
+# idle threads (waiting for work or io readiness) are not sampled. an idle event loop thread has the loop
+# runner on top: uvloop polls in C, so no selectors frame
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py", os.path.join("concurrent", "futures", "thread.py"),
+              os.path.join("asyncio", "runners.py"), os.path.join("uvloop", "__init__.py"))
+
+
+def _frame_name(frame, lines: bool = False) -> str:
+    name = f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}"
+    return f"{name}:{frame.f_lineno}" if lines else name
+
+
+def _stack(frame, thread_name: str, lines: bool = False) -> str | None:
+    if frame.f_code.co_filename.endswith(IDLE_FILES):
+        return None
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(_frame_name(frame, lines))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class RequestProfiler:
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, routes: List[str] = PROFILE_ROUTES,
+                 interval_ms: float = PROFILE_INTERVAL_MS, out_dir: str = PROFILE_DIR,
+                 enabled: bool = PROFILE_ENABLED, lines: bool = PROFILE_LINES, max_files: int = PROFILE_MAX_FILES):
+        self.sample_rate = sample_rate
+        self.routes = routes
+        self.interval_ms = interval_ms
+        self.out_dir = out_dir
+        self.enabled = enabled
+        self.lines = lines
+        self.max_files = max_files
+        self._files: deque | None = None  # written files, oldest first (listed on first write)
+        self.profiled = 0
+        self._active: Dict[int, Counter] = {}  # in flight profiled requests: id -> stack counts
+        self._finished: List[Tuple[str, Counter]] = []  # file name, stack counts: written by the sampler thread
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def configure(self, enabled: bool | None = None, sample_rate: float | None = None,
+                  routes: List[str] | None = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if routes is not None:
+            self.routes = routes
+        log.info(f"profiler: enabled={self.enabled}, sample rate {self.sample_rate}, routes {self.routes}")
+
+    def status(self) -> Dict[str, object]:
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "routes": self.routes,
+                "interval_ms": self.interval_ms, "out_dir": self.out_dir, "profiled": self.profiled}
+
+    def _should_profile(self, request: Request) -> bool:
+        return (request.url.path.rstrip("/") in self.routes
+                or random.random() < self.sample_rate
+                or is_service_token(request.headers.get(PROFILE_HEADER)))
+
+    async def __call__(self, request: Request, call_next):
+        if not self.enabled or not self._should_profile(request):
+            return await call_next(request)
+
+        samples = Counter()
+        key = id(samples)
+        with self._lock:
+            self._active[key] = samples
+        self._wakeup.set()
+        t = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            # streamed bodies (ndjson batch) are sampled until the handler returned the response only
+            elapsed_ms = (time.perf_counter() - t) * 1000
+            self.profiled += 1
+            path = request.url.path.strip("/").replace("/", "_") or "root"
+            name = f"{datetime.now(UTC):%Y%m%dT%H%M%S.%f}_{request.method}_{path}_{status}_{elapsed_ms:.0f}ms.folded"
+            with self._lock:
+                del self._active[key]
+                self._finished.append((name, samples))
+            self._wakeup.set()
+        response.headers["X-Profile-Samples"] = str(sum(samples.values()))
+        return response
+
+    def _write_finished(self):
+        with self._lock:
+            finished, self._finished = self._finished, []
+        for name, samples in finished:
+            try:
+                os.makedirs(self.out_dir, exist_ok=True)
+                if self._files is None:
+                    # names start with the time: sorted is oldest first
+                    self._files = deque(sorted(f for f in os.listdir(self.out_dir) if f.endswith(".folded")))
+                with open(os.path.join(self.out_dir, name), "w") as f:
+                    for stack, count in samples.most_common():
+                        f.write(f"{stack} {count}\n")
+                self._files.append(name)
+                while len(self._files) > self.max_files:
+                    os.remove(os.path.join(self.out_dir, self._files.popleft()))
+            except OSError as e:
+                log.error(f"write profile {name} failed: {e}")
+
+    # sampler thread
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = Counter()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = _stack(frame, names.get(ident, str(ident)), self.lines)
+            if stack:
+                stacks[stack] += 1
+        with self._lock:
+            for samples in self._active.values():
+                samples.update(stacks)
+
+    def _run(self):
+        interval = self.interval_ms / 1000
+        while not self._stop.is_set():
+            self._write_finished()
+            with self._lock:
+                idle = not self._active
+            if idle:
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            self._sample()
+            time.sleep(interval)
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._write_finished()
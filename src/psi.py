@@ -1,12 +1,21 @@
+import asyncio
+import base64
+import binascii
+import json
 import logging
+import os
 import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime, UTC, timedelta
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, Literal
 
 from fastapi import APIRouter
-from fastapi import HTTPException
+from fastapi import HTTPException, Query, Request, Response
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel, Field
+from responses import json_response, raw_json_response
 from sec import currUserDep
 
 log = logging.getLogger(__name__)
@@ -14,6 +23,31 @@ log = logging.getLogger(__name__)
 router = APIRouter(prefix="/psi", tags=["PSI"])
 
 SESSION_TIMEOUT_MINUTES = 30
+DIGEST_BITS_ALLOWED = range(32, 257, 8)
+VALUE_BYTES = 256  # blinded values are elements of the 2048-bit group, stored fixed width big endian
+MAX_UPLOAD_BYTES = int(os.getenv("PSI_MAX_UPLOAD_BYTES", 32 * 2 ** 20))  # per payload (json or chunked)
+MAX_CHUNK_BYTES = 4 * 2 ** 20
+MAX_VALUES = MAX_UPLOAD_BYTES // VALUE_BYTES
+MAX_WAIT_SECONDS = 60  # long poll
+MAX_UPLOADS_PER_USER = 4
+MAX_UPLOAD_BUFFER_BYTES = int(os.getenv("PSI_MAX_UPLOAD_BUFFER_BYTES", 512 * 2 ** 20))  # all open uploads
+SWEEP_INTERVAL_SECONDS = 60
+
+
+def pack_values(values: List[int]) -> bytes:
+    """list of ints -> one contiguous buffer of len(values) * VALUE_BYTES"""
+    try:
+        return b"".join(v.to_bytes(VALUE_BYTES, 'big') for v in values)
+    except OverflowError:
+        raise HTTPException(status_code=400, detail="Invalid value (must be in 0..2^2048)")
+
+
+def unpack_values(buf: bytes | memoryview) -> List[int]:
+    return [int.from_bytes(buf[i:i + VALUE_BYTES], 'big') for i in range(0, len(buf), VALUE_BYTES)]
+
+
+def n_values(buf: bytes | memoryview) -> int:
+    return len(buf) // VALUE_BYTES
 
 
 class SessionStatus(Enum):
@@ -23,14 +57,34 @@ class SessionStatus(Enum):
 
 
 class InitiateRequest(BaseModel):
-    blinded_values: List[int]
+    blinded_values: List[int] = Field(..., max_length=MAX_VALUES)
     user_id: str
 
 
 class JoinRequest(BaseModel):
+    """response_values: H(y)^b for joiner items, followed by H(x)^ab for initiator items.
+    digest mode (digest_bits set): response_values holds only H(y)^b, and H(x)^ab are sent as
+    truncated digests - base64 of concatenated digest_bits/8 byte digests, in initiator item order"""
     session_id: str
-    response_values: List[int]
+    response_values: List[int] = Field(..., max_length=MAX_VALUES)
     user_id: str
+    digest_bits: int | None = None
+    response_digests: str | None = None
+
+
+@dataclass(slots=True)
+class ResponseDigests:
+    bits: int
+    data: bytes  # concatenated fixed width digests
+
+
+class UploadOpenRequest(BaseModel):
+    """chunked upload of a packed payload (see pack_values) instead of a json body.
+    init: initiator values. join: joiner values, followed by digests if digest_bits is set (see JoinRequest)"""
+    purpose: Literal["init", "join"]
+    size: int = Field(..., gt=0, le=MAX_UPLOAD_BYTES)  # total payload bytes
+    session_id: str | None = None  # join only
+    digest_bits: int | None = None  # join only
 
 
 class IntersectionUpdateRequest(BaseModel):
@@ -39,39 +93,52 @@ class IntersectionUpdateRequest(BaseModel):
     len_intersection: int = Field(..., ge=0)
 
 
-class SessionData(BaseModel):
-    initiator_values: List[int]
+@dataclass(slots=True)
+class SessionData:
+    """values are packed buffers (see pack_values), not lists of ints: ~256 bytes per value instead of
+    a boxed 2048-bit int + list slot each"""
+    initiator_values: bytes
     status: int
     user_id: str
     created_at: datetime
-    response_values: Dict[str, List[int]] = {}
-    intersection: Dict[str, int] = {}
+    response_values: Dict[str, bytes] = field(default_factory=dict)
+    response_digests: Dict[str, ResponseDigests] = field(default_factory=dict)
+    intersection: Dict[str, int] = field(default_factory=dict)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)  # set (and replaced) on every change
+
+    def notify(self):
+        """wake up long polls. status changes happen on the event loop (async routes)"""
+        self.changed.set()
+        self.changed = asyncio.Event()
 
 
 class SessionManager:
     def __init__(self):
         self.sessions: Dict[str, SessionData] = {}
 
-    def create_session(self, user_id: str, values: List[int]) -> str:
+    def create_session(self, user_id: str, values: bytes) -> str:
         session_id = str(uuid.uuid4())
         self.sessions[session_id] = SessionData(
             initiator_values=values,
-            status=SessionStatus.INITIATED,
+            status=SessionStatus.INITIATED.value,
             user_id=user_id,
             created_at=datetime.now(UTC)
         )
         return session_id
 
-    def get(self, session_id: str) -> SessionData:
-        return self.sessions[session_id]
+    def get(self, session_id: str) -> SessionData | None:
+        return self.sessions.get(session_id)
 
     def remove(self, session_id: str):
-        del self.sessions[session_id]
+        session = self.sessions.pop(session_id, None)
+        if session:
+            session.notify()  # long polls return (expired)
 
-    def cleanup_expired_sessions(self):
-        for sid, session in self.sessions.items():
-            if self.is_expired(session):
-                del self.sessions[sid]
+    def cleanup_expired_sessions(self) -> int:
+        expired = [sid for sid, session in self.sessions.items() if self.is_expired(session)]
+        for sid in expired:
+            self.remove(sid)
+        return len(expired)
 
     @classmethod
     def is_expired(cls, session):
@@ -82,19 +149,76 @@ class SessionManager:
 session_manager = SessionManager()
 
 
-@router.post("/init", status_code=201)
-async def initiate_psi(request: InitiateRequest, current_user: currUserDep):
-    """store initiator's blinded values and create session."""
-    if not request.blinded_values:
-        raise HTTPException(status_code=400, detail="Invalid request")
-
-    session_id = session_manager.create_session(current_user.user_id, request.blinded_values)
-    return {"session_id": session_id}
-
-
-@router.post("/{session_id}/join")
-async def join_psi(session_id: str, request: JoinRequest, current_user: currUserDep):
-    """store joiner's response values and update session status."""
+@dataclass(slots=True)
+class Upload:
+    user_id: str
+    purpose: str
+    size: int
+    created_at: datetime
+    session_id: str | None = None
+    digest_bits: int | None = None
+    data: bytearray = field(default_factory=bytearray)
+    appending: bool = False  # a PATCH is streaming into data
+
+
+class UploadManager:
+    """open uploads, bounded per user and by total declared size (buffered bytes at most)"""
+    def __init__(self, max_per_user: int = MAX_UPLOADS_PER_USER, max_bytes: int = MAX_UPLOAD_BUFFER_BYTES):
+        self.max_per_user = max_per_user
+        self.max_bytes = max_bytes
+        self.uploads: Dict[str, Upload] = {}
+        self.reserved_bytes = 0
+        self.per_user: Dict[str, int] = defaultdict(int)
+
+    def create(self, upload: Upload) -> str:
+        if self.per_user[upload.user_id] >= self.max_per_user:
+            raise HTTPException(status_code=429, detail=f"Too many open uploads (max {self.max_per_user})")
+        if self.reserved_bytes + upload.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Upload buffer full, retry later")
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = upload
+        self.reserved_bytes += upload.size
+        self.per_user[upload.user_id] += 1
+        return upload_id
+
+    def get(self, upload_id: str, user_id: str) -> Upload:
+        upload = self.uploads.get(upload_id)
+        if not upload or upload.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        if SessionManager.is_expired(upload):
+            self.remove(upload_id)
+            raise HTTPException(status_code=410, detail="Upload expired")
+        return upload
+
+    def remove(self, upload_id: str):
+        upload = self.uploads.pop(upload_id, None)
+        if upload:
+            self.reserved_bytes -= upload.size
+            self.per_user[upload.user_id] -= 1
+            if not self.per_user[upload.user_id]:
+                del self.per_user[upload.user_id]
+
+    def cleanup_expired(self) -> int:
+        """abandoned uploads, also those nobody accesses again"""
+        expired = [uid for uid, upload in self.uploads.items() if SessionManager.is_expired(upload)]
+        for uid in expired:
+            self.remove(uid)
+        return len(expired)
+
+
+upload_manager = UploadManager()
+
+
+async def sweep_expired(interval_seconds: float = SWEEP_INTERVAL_SECONDS):
+    """drop expired sessions and uploads periodically. runs on the event loop (lifespan task), like the routes"""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        sessions, uploads = session_manager.cleanup_expired_sessions(), upload_manager.cleanup_expired()
+        if sessions or uploads:
+            log.info(f"dropped {sessions} expired psi sessions, {uploads} expired uploads")
+
+
+def _joinable_session(session_id: str) -> SessionData:
     session = session_manager.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -104,26 +228,161 @@ async def join_psi(session_id: str, request: JoinRequest, current_user: currUser
         raise HTTPException(status_code=410, detail="Session expired")
 
     if session.status != SessionStatus.INITIATED.value:
-        raise HTTPException(status_code=400, detail=f"Invalid session status ({session["status"]}, not 1)")
+        raise HTTPException(status_code=400, detail=f"Invalid session status ({session.status}, not 1)")
+    return session
+
+
+def _join_session(session_id: str, user_id: str, values: bytes, digest_bits: int | None, digests: bytes | None):
+    """store joiner's packed response values (and digests) and update session status."""
+    session = _joinable_session(session_id)
 
-    session.response_values[current_user.user_id] = request.response_values
+    if digest_bits is not None:
+        if len(digests) != n_values(session.initiator_values) * digest_bits // 8:
+            raise HTTPException(status_code=400, detail="Invalid number of digests")
+        session.response_digests[user_id] = ResponseDigests(bits=digest_bits, data=digests)
+
+    session.response_values[user_id] = values
     session.status = SessionStatus.JOINED.value
+    session.notify()
 
     return {"status": session.status, "session_id": session_id}
 
 
+@router.post("/init", status_code=201)
+async def initiate_psi(request: InitiateRequest, current_user: currUserDep):
+    """store initiator's blinded values and create session."""
+    if not request.blinded_values:
+        raise HTTPException(status_code=400, detail="Invalid request")
+
+    session_id = session_manager.create_session(current_user.user_id, pack_values(request.blinded_values))
+    return {"session_id": session_id}
+
+
+@router.post("/uploads", status_code=201)
+async def open_upload(request: UploadOpenRequest, current_user: currUserDep):
+    """open a chunked upload. append with PATCH /uploads/{upload_id}?offset=n, then POST .../seal"""
+    if request.purpose == "join":
+        if request.session_id is None:
+            raise HTTPException(status_code=400, detail="session_id required")
+        if request.digest_bits is not None and request.digest_bits not in DIGEST_BITS_ALLOWED:
+            raise HTTPException(status_code=400, detail="Invalid digest request")
+
+    upload_id = upload_manager.create(Upload(
+        user_id=current_user.user_id,
+        purpose=request.purpose,
+        size=request.size,
+        created_at=datetime.now(UTC),
+        session_id=request.session_id,
+        digest_bits=request.digest_bits,
+    ))
+    return {"upload_id": upload_id, "offset": 0}
+
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: currUserDep):
+    """bytes received so far, to resume an interrupted upload"""
+    upload = upload_manager.get(upload_id, current_user.user_id)
+    return {"offset": len(upload.data), "size": upload.size}
+
+
+@router.patch("/uploads/{upload_id}")
+async def append_upload(upload_id: str, offset: int, request: Request, current_user: currUserDep):
+    """append raw bytes (request body) at offset. the body is streamed into the upload buffer,
+    so after a dropped connection the client resumes from the offset reported by GET /uploads/{upload_id}"""
+    upload = upload_manager.get(upload_id, current_user.user_id)
+    if upload.appending:
+        raise HTTPException(status_code=409, detail="Upload in progress")
+    if offset != len(upload.data):
+        raise HTTPException(status_code=409, detail=f"Offset mismatch (expected {len(upload.data)})")
+
+    received = 0
+    upload.appending = True
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_CHUNK_BYTES or len(upload.data) + len(chunk) > upload.size:
+                raise HTTPException(status_code=413, detail="Chunk or upload too large")
+            upload.data += chunk
+    except ClientDisconnect:
+        log.info(f"upload {upload_id} interrupted at offset {len(upload.data)}")
+    finally:
+        upload.appending = False
+
+    return {"offset": len(upload.data), "size": upload.size}
+
+
+@router.post("/uploads/{upload_id}/seal")
+async def seal_upload(upload_id: str, response: Response, current_user: currUserDep):
+    """complete upload: create session (init, 201) or join session (join).
+    the upload is kept if the payload or session is rejected"""
+    upload = upload_manager.get(upload_id, current_user.user_id)
+    if upload.appending:
+        raise HTTPException(status_code=409, detail="Upload in progress")
+    if len(upload.data) != upload.size:
+        raise HTTPException(status_code=400, detail=f"Upload incomplete ({len(upload.data)}/{upload.size} bytes)")
+
+    n_value_bytes = upload.size
+    if upload.purpose == "join":
+        session = _joinable_session(upload.session_id)
+        if upload.digest_bits is not None:
+            n_value_bytes -= n_values(session.initiator_values) * upload.digest_bits // 8
+    if n_value_bytes < 0 or n_value_bytes % VALUE_BYTES:
+        raise HTTPException(status_code=400, detail="Invalid payload size")
+
+    upload_manager.remove(upload_id)
+    data = bytes(upload.data)
+    if upload.purpose == "init":
+        session_id = session_manager.create_session(current_user.user_id, data)
+        response.status_code = 201
+        return {"session_id": session_id}
+
+    digests = data[n_value_bytes:] if upload.digest_bits is not None else None
+    return _join_session(upload.session_id, current_user.user_id, data[:n_value_bytes], upload.digest_bits, digests)
+
+
+@router.post("/{session_id}/join")
+async def join_psi(session_id: str, request: JoinRequest, current_user: currUserDep):
+    """store joiner's response values and update session status."""
+    digests = None
+    if request.digest_bits is not None:
+        if request.digest_bits not in DIGEST_BITS_ALLOWED or request.response_digests is None:
+            raise HTTPException(status_code=400, detail="Invalid digest request")
+        try:
+            digests = base64.b64decode(request.response_digests, validate=True)
+        except binascii.Error:
+            raise HTTPException(status_code=400, detail="Invalid digest encoding")
+
+    values = pack_values(request.response_values)
+    return _join_session(session_id, current_user.user_id, values, request.digest_bits, digests)
+
+
 @router.get("/{session_id}")
-async def get_values(session_id: str, current_user: currUserDep):
+async def get_values(session_id: str, current_user: currUserDep,
+                     encoding: Literal["int", "b64"] = "int",
+                     offset: int = Query(0, ge=0), limit: int | None = Query(None, ge=1)):
+    """values as lists of ints (encoding=int) or as base64 of the packed buffer (encoding=b64, cheaper).
+    offset/limit select a range of initiator values (zero-copy slice of the stored buffer)"""
     session = session_manager.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
+    if encoding == "int":
+        # 2048-bit ints: stdlib json (orjson is limited to 64 bit ints)
+        encode, response = unpack_values, (lambda content: raw_json_response(json.dumps(content)))
+    else:
+        encode, response = (lambda buf: base64.b64encode(buf).decode()), json_response
+
     if session.status == SessionStatus.INITIATED.value:
-        return {"values": session.initiator_values, "status": SessionStatus.INITIATED.value}
+        values = memoryview(session.initiator_values)
+        end = None if limit is None else (offset + limit) * VALUE_BYTES
+        return response({"values": encode(values[offset * VALUE_BYTES:end]), "status": SessionStatus.INITIATED.value})
     elif session.status == SessionStatus.JOINED.value:
         if current_user.user_id != session.user_id:
             raise HTTPException(status_code=403, detail="Access allowed only for initiator")
-        return {"values": session.response_values, "status": SessionStatus.JOINED.value}
+        values = {user: encode(buf) for user, buf in session.response_values.items()}
+        digests = {user: {"bits": d.bits, "data": base64.b64encode(d.data).decode()}
+                   for user, d in session.response_digests.items()}
+        return response({"values": values, "digests": digests, "status": SessionStatus.JOINED.value})
     else:
         log.error(f"Invalid session status: {session.status}")
         raise HTTPException(status_code=400, detail="Invalid session status")
@@ -145,6 +404,7 @@ async def update_intersection_result(session_id: str, request: IntersectionUpdat
     # update
     session.intersection[request.other_user_id] = request.len_intersection
     session.status = SessionStatus.COMPLETED.value
+    session.notify()
 
     return {"status": f"Intersection updated to {request.len_intersection}"}
 
@@ -157,3 +417,40 @@ async def get_intersection_result(session_id: str, current_user: currUserDep):
 
     n = session.intersection.get(current_user.user_id, -1)
     return {"intersection_len": n}
+
+
+@router.get("/{session_id}/wait")
+async def wait_for_step(session_id: str, current_user: currUserDep, until: Literal["joined", "intersection"],
+                        timeout: float = Query(25, gt=0, le=MAX_WAIT_SECONDS)):
+    """long poll instead of polling GET /psi/{session_id} or /intersection: returns as soon as the session
+    is joined (initiator, until=joined) or the caller's intersection count is set (joiner, until=intersection),
+    or after timeout seconds with ready false"""
+    session = session_manager.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    if until == "joined" and current_user.user_id != session.user_id:
+        raise HTTPException(status_code=403, detail="Access allowed only for initiator")
+    if until == "intersection" and current_user.user_id not in session.response_values:
+        raise HTTPException(status_code=403, detail="Access allowed only for joiners")
+
+    def ready() -> bool:
+        if until == "joined":
+            return session.status >= SessionStatus.JOINED.value
+        return current_user.user_id in session.intersection
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not ready() and not session_manager.is_expired(session):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(session.changed.wait(), remaining)
+        except TimeoutError:
+            break
+
+    result = {"status": session.status, "ready": ready()}
+    if until == "intersection":
+        result["intersection_len"] = session.intersection.get(current_user.user_id, -1)
+    return result
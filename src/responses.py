@@ -0,0 +1,19 @@
+"""
+pre-serialized json responses for hot routes. returning a Response directly skips response model
+validation and jsonable_encoder; routes keep response_model for the api docs.
+"""
+from typing import Any, Dict
+
+import orjson
+from fastapi import Response
+
+
+def json_response(content: Any, status_code: int = 200, headers: Dict[str, str] | None = None) -> Response:
+    """orjson encoded (ints limited to 64 bit)"""
+    return Response(content=orjson.dumps(content), status_code=status_code, headers=headers,
+                    media_type="application/json")
+
+
+def raw_json_response(content: bytes | str, status_code: int = 200, headers: Dict[str, str] | None = None) -> Response:
+    """already encoded json, e.g. built by postgres"""
+    return Response(content=content, status_code=status_code, headers=headers, media_type="application/json")
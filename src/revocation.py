@@ -0,0 +1,100 @@
+"""
+in-memory token revocation list for stateless token validation (AUTH_MODE=stateless).
+
+holds only users whose tokens are not accepted: disabled users, and users with tokens_valid_after set
+(tokens issued before are revoked). loaded on start, then refreshed every REVOCATION_REFRESH_SECONDS
+from the users rows changed since the last refresh (updated_at, kept by trigger), plus a full reload
+every REVOCATION_FULL_RELOAD_SECONDS. a change takes effect within one refresh interval (per process).
+"""
+import logging
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Dict
+
+from sqlalchemy import text
+
+from db_ import SessionLocal, USERS_TABLE_NAME
+
+log = logging.getLogger(__name__)
+
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", 5))
+REVOCATION_FULL_RELOAD_SECONDS = 600
+REVOCATION_OVERLAP_SECONDS = 60  # re-read recent changes: a late commit can carry an older updated_at
+
+
+class RevocationList:
+    def __init__(self, refresh_seconds: float = REVOCATION_REFRESH_SECONDS, enabled: bool = False):
+        self.refresh_seconds = refresh_seconds
+        self.enabled = enabled
+        self.revoked: Dict[str, float] = {}  # user_id -> tokens issued before (epoch seconds) are revoked
+        self._since: datetime | None = None  # max updated_at seen
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_revoked(self, user_id: str, issued_at: float | None) -> bool:
+        valid_after = self.revoked.get(user_id)
+        return valid_after is not None and (issued_at or 0) < valid_after
+
+    def update(self, user_id: str, disabled: bool, tokens_valid_after: datetime | None):
+        with self._lock:
+            if disabled:
+                self.revoked[user_id] = math.inf
+            elif tokens_valid_after is not None:
+                self.revoked[user_id] = tokens_valid_after.timestamp()
+            else:
+                self.revoked.pop(user_id, None)
+
+    def refresh(self, full: bool = False) -> int:
+        """returns the number of users rows read"""
+        with SessionLocal() as session:
+            if full or self._since is None:
+                since = session.execute(text(f"SELECT max(updated_at) FROM {USERS_TABLE_NAME}")).scalar()
+                rows = session.execute(text(f"""
+                SELECT user_id, disabled, tokens_valid_after FROM {USERS_TABLE_NAME}
+                WHERE disabled OR tokens_valid_after IS NOT NULL
+                """)).fetchall()
+                revoked = {}
+                for user_id, disabled, tokens_valid_after in rows:
+                    revoked[user_id] = math.inf if disabled else tokens_valid_after.timestamp()
+                with self._lock:
+                    self.revoked = revoked
+            else:
+                rows = session.execute(text(f"""
+                SELECT user_id, disabled, tokens_valid_after, updated_at FROM {USERS_TABLE_NAME}
+                WHERE updated_at > CAST(:since AS timestamptz) - make_interval(secs => :overlap)
+                """), {"since": self._since, "overlap": REVOCATION_OVERLAP_SECONDS}).fetchall()
+                since = max([self._since] + [row.updated_at for row in rows])
+                for user_id, disabled, tokens_valid_after, _ in rows:
+                    self.update(user_id, disabled, tokens_valid_after)
+        self._since = since
+        return len(rows)
+
+    # background job
+    def _run(self):
+        reload_every = max(1, round(REVOCATION_FULL_RELOAD_SECONDS / self.refresh_seconds))
+        i = 0
+        while not self._stop.wait(self.refresh_seconds):
+            i += 1
+            try:
+                self.refresh(full=i % reload_every == 0)
+            except Exception as e:
+                log.error(f"revocation list refresh failed: {e}")
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        log.info(f"start revocation list (refresh every {self.refresh_seconds}s)")
+        self.refresh(full=True)  # before serving: revoked users must not pass meanwhile
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="revocation-list", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -80,7 +80,7 @@ _london_points = [
 ]
 
 DB_LONDON_VALUES = ",\n".join([
-    f"('{name}', ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326), NOW())"
+    f"('{name}', ST_SetSRID(ST_MakePoint({lon}, {lat}), 4326)::geography, NOW())"
     for name, lon, lat in _london_points
 ])
 
@@ -2,6 +2,7 @@
 based on fastapi docs https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt but with db
 """
 import os
+import secrets
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
@@ -15,10 +16,12 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 from pydantic import BaseModel
+from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker
 
-from db_ import engine, UserDB
+from db_ import engine, UserDB, USERS_TABLE_NAME
+from revocation import RevocationList
 
 log = logging.getLogger(__name__)
 
@@ -34,15 +37,26 @@ setattr(bcrypt, "__about__", SolveBugBcryptWarning())
 SECRET_KEY = os.getenv("SECRET_KEY", None)
 SECRET_KEY = (SECRET_KEY or "33e07a088f7151c808c149eb2485191d138a56983730487d13d93acfdc276804")  # test key
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# db: user row read per request | stateless: claims only, disabled/revoked users from the in-memory revocation list
+AUTH_MODE = os.getenv("AUTH_MODE", "db")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 5 if AUTH_MODE == "stateless" else 30))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 7))
+# static bearer token for internal services (e.g. matching service). service routes are disabled if unset
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", None)
 
 router = APIRouter()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+revocations = RevocationList(enabled=AUTH_MODE == "stateless")
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
@@ -58,6 +72,13 @@ class UserInDB(User):
     hashed_password: str
 
 
+@dataclass(slots=True)
+class TokenUser:
+    """current user from the token claims (stateless mode), same attributes as UserDB used by routes"""
+    user_id: str
+    disabled: bool = False
+
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login_for_access_token")
 
@@ -83,20 +104,45 @@ def authenticate_user(user_id: str, password: str):
     return user
 
 
-def create_access_token(data: dict, expires_delta: timedelta | None = None):
+def create_access_token(data: dict, expires_delta: timedelta | None = None, token_type: str = "access"):
     to_encode = data.copy()
+    now = datetime.now(timezone.utc)
     if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
+        expire = now + expires_delta
     else:
         # default expire time
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
+        expire = now + timedelta(minutes=15)
 
-    to_encode.update({"exp": expire})
+    # iat with sub-second precision: compared to tokens_valid_after on revocation
+    to_encode.update({"exp": expire, "iat": now.timestamp(), "typ": token_type})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
     return encoded_jwt
 
 
+def _issue_tokens(user_id: str, refresh_token: str | None = None) -> Token:
+    access_token = create_access_token(data={"sub": user_id},
+                                       expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    refresh_token = refresh_token or create_access_token(data={"sub": user_id},
+                                                         expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+                                                         token_type="refresh")
+    return Token(access_token=access_token, token_type="bearer", refresh_token=refresh_token)
+
+
+def _issued_before(issued_at: float | None, tokens_valid_after: datetime | None) -> bool:
+    return tokens_valid_after is not None and (issued_at or 0) < tokens_valid_after.timestamp()
+
+
+def token_subject(authorization: str | None) -> str | None:
+    """user id from an 'Authorization: Bearer <jwt>' header value, without db lookup. None if missing/invalid"""
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    try:
+        return jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except InvalidTokenError:
+        return None
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     """retrieves user from JWT token.
     FastAPI will automatically extract the token from the request using the oauth2_scheme dependency,
@@ -117,16 +163,26 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         if username is None:
             log.error(f"username not found in token")
             raise credentials_exception
+        if payload.get("typ") == "refresh":
+            log.error(f"refresh token used as access token")
+            raise credentials_exception
 
         token_data = TokenData(username=username)
     except InvalidTokenError:
         log.error(f"invalid token")
         raise credentials_exception
 
+    if revocations.enabled:
+        # stateless: pure cpu check, no user query
+        if revocations.is_revoked(token_data.username, payload.get("iat")):
+            log.error(f"revoked token: {token_data.username}")
+            raise credentials_exception
+        return TokenUser(user_id=token_data.username)
+
     # user from db
     user = get_user(user_id=token_data.username)
-    if user is None:
-        log.error(f"user not found in db: {token_data.username}")
+    if user is None or _issued_before(payload.get("iat"), user.tokens_valid_after):
+        log.error(f"user not found in db or token revoked: {token_data.username}")
         raise credentials_exception
 
     return user
@@ -138,6 +194,21 @@ async def get_current_active_user(current_user: Annotated[User, Depends(get_curr
     return current_user
 
 
+def is_service_token(token: str | None) -> bool:
+    return bool(SERVICE_TOKEN and token) and secrets.compare_digest(token.encode(), SERVICE_TOKEN.encode())
+
+
+async def verify_service_token(token: Annotated[str, Depends(oauth2_scheme)]):
+    """authorize service-to-service calls (not tied to a user)"""
+    if not is_service_token(token):
+        log.error(f"invalid service token")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
 ############################
 
 # User model with a dependency on a function:
@@ -145,6 +216,7 @@ async def get_current_active_user(current_user: Annotated[User, Depends(get_curr
 # FastAPI will automatically call get_current_active_user
 # to retrieve the current active user and pass it to the route handler.
 currUserDep = Annotated[User, Depends(get_current_active_user)]
+serviceDep = Depends(verify_service_token)  # use in route dependencies=[serviceDep]
 
 
 @router.post("/login_for_access_token", response_model=Token)  # path same as tokenUrl in OAuth2PasswordBearer
@@ -158,10 +230,49 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.user_id}, expires_delta=access_token_expires)
+    return _issue_tokens(user.user_id)
+
+
+@router.post("/refresh_access_token", response_model=Token)
+def refresh_access_token(request: RefreshRequest) -> Token:
+    """new access token for a refresh token, no bcrypt. checks the user row (disabled, revoked)"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        log.error(f"invalid refresh token")
+        raise credentials_exception
+    if payload.get("typ") != "refresh" or payload.get("sub") is None:
+        log.error(f"not a refresh token")
+        raise credentials_exception
+
+    user = get_user(user_id=payload["sub"])
+    if user is None or user.disabled or _issued_before(payload.get("iat"), user.tokens_valid_after):
+        log.error(f"refresh denied: {payload['sub']}")
+        raise credentials_exception
+
+    return _issue_tokens(user.user_id, refresh_token=request.refresh_token)
+
+
+@router.post("/users/{user_id}/revoke_tokens", dependencies=[serviceDep])
+def revoke_tokens(user_id: str):
+    """revoke all access and refresh tokens of a user issued until now (service token).
+    stateless mode: other processes pick it up within REVOCATION_REFRESH_SECONDS"""
+    with SessionLocal() as session:
+        row = session.execute(text(f"""
+        UPDATE {USERS_TABLE_NAME} SET tokens_valid_after = clock_timestamp() WHERE user_id = :user_id
+        RETURNING disabled, tokens_valid_after
+        """), {"user_id": user_id}).first()
+        session.commit()
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found")
 
-    return Token(access_token=access_token, token_type="bearer")
+    revocations.update(user_id, row.disabled, row.tokens_valid_after)
+    return {"user_id": user_id, "tokens_valid_after": row.tokens_valid_after}
 
 
 @router.get("/users/me/")
@@ -170,8 +281,8 @@ async def read_users_me(current_user: currUserDep):
 
 
 #############
-def create_initial_user(user_id: str, password: str, session):
-    hashed_password = get_password_hash(password)
+def create_initial_user(user_id: str, password: str, session, hashed_password: str | None = None):
+    hashed_password = hashed_password or get_password_hash(password)
 
     user_data = {
         "user_id": user_id,
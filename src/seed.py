@@ -0,0 +1,51 @@
+"""
+sample users (password "secret") and their locations. explicit command, not run on server start.
+
+usage: python seed.py
+"""
+import logging
+
+from sqlalchemy import text
+
+from db_ import SessionLocal, USERS_TABLE_NAME, init_lock, insert_location_data
+from migrations import migrate
+from sample_data import DB_LONDON_VALUES
+from sec import create_initial_user, get_password_hash
+
+log = logging.getLogger(__name__)
+
+
+def insert_initial_users():
+    # get all usernames, add password to missing users
+    sample_user_ids = []
+    for line in DB_LONDON_VALUES.strip().splitlines():
+        u = line.split(",")[0].strip("'")
+        u = u.replace("('", "").strip()
+        if u:
+            sample_user_ids.append(u)
+
+    log.info(f"insert {sample_user_ids} {len(sample_user_ids)} initial users")
+    with SessionLocal() as session:
+        q = text(f"""SELECT user_id FROM {USERS_TABLE_NAME};""")
+        result = session.execute(q)
+        user_ids_with_pw = {row.user_id for row in result}
+        missing = [user_id for user_id in sample_user_ids if user_id not in user_ids_with_pw]
+        if missing:
+            hashed_password = get_password_hash("secret")  # sample users share one hash: one bcrypt round
+            for user_id in missing:
+                create_initial_user(user_id=user_id, password="secret", session=session,
+                                    hashed_password=hashed_password)
+        session.commit()
+
+
+def seed():
+    migrate()
+    with init_lock():
+        insert_initial_users()
+        insert_location_data()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)-8s %(module)s:%(funcName)s:%(lineno)d - %(message)s")
+    seed()
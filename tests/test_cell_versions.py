@@ -0,0 +1,42 @@
+"""nearby etags from per cell write counters (in memory, no db)"""
+import cell_versions
+from cell_versions import CellVersions
+
+LONDON = (51.5, -0.12)
+KEY = "k=20&max_distance=5"
+
+
+def test_match_until_nearby_write():
+    versions = CellVersions(enabled=True)
+    tag = versions.etag(*LONDON, radius_km=5, key=KEY)
+    assert versions.match(tag, radius_km=5, key=KEY) == tag
+    assert versions.match(f'"other", W/{tag}', radius_km=5, key=KEY) == tag  # list, weak prefix
+
+    versions.bump(48.85, 2.35)  # paris: outside the radius
+    assert versions.match(tag, radius_km=5, key=KEY) == tag
+    versions.bump(LONDON[0] + 0.03, LONDON[1])  # ~3 km away
+    assert versions.match(tag, radius_km=5, key=KEY) is None
+    assert versions.etag(*LONDON, radius_km=5, key=KEY) != tag
+
+
+def test_tag_bound_to_key_generation_and_epoch(monkeypatch):
+    versions = CellVersions(enabled=True)
+    tag = versions.etag(*LONDON, radius_km=5, key=KEY)
+    assert versions.match(tag, radius_km=5, key="k=10&max_distance=5") is None
+    assert CellVersions(enabled=True).match(tag, radius_km=5, key=KEY) is None  # restarted process
+    assert versions.match('"not.a.tag"', radius_km=5, key=KEY) is None
+
+    now = cell_versions.time.time()
+    monkeypatch.setattr(cell_versions.time, "time", lambda: now + versions.max_age_seconds)
+    assert versions.match(tag, radius_km=5, key=KEY) is None  # expired
+
+
+def test_large_radius_and_disabled():
+    versions = CellVersions(enabled=True)
+    assert versions.etag(*LONDON, radius_km=500, key=KEY) is None  # more than MAX_CELLS
+
+    disabled = CellVersions(enabled=False)
+    disabled.bump(*LONDON)
+    assert not disabled.counters
+    assert disabled.etag(*LONDON, radius_km=5, key=KEY) is None
+    assert disabled.match(versions.etag(*LONDON, radius_km=5, key=KEY), radius_km=5, key=KEY) is None
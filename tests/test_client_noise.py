@@ -0,0 +1,26 @@
+"""client location noise: truncated radius from the inverse cdf table"""
+import math
+
+import numpy as np
+
+from client import Noise, _radius_inverse_cdf
+
+
+def test_radius_table():
+    cdf, radii = _radius_inverse_cdf(1.0, 3.0)
+    assert _radius_inverse_cdf(1.0, 3.0)[0] is cdf  # cached per (epsilon, rmax)
+    assert radii[0] == 0 and radii[-1] == 3.0
+    assert cdf[0] == 0 and math.isclose(cdf[-1], 1.0)
+    assert np.all(np.diff(cdf) >= 0)
+
+    below = radii < 0.7 * 3.0  # below the truncation band: the planar laplace cdf itself
+    assert np.allclose(cdf[below], 1 - (1 + radii[below]) * np.exp(-radii[below]))
+
+
+def test_truncated_samples():
+    np.random.seed(0)
+    noise = Noise(epsilon=1.0, rmax=3)
+    radii = np.array([noise._sample_polar_truncated()[0] for _ in range(20_000)])
+    assert radii.min() >= 0 and radii.max() <= 3
+    assert abs(np.mean(radii <= 1.0) - (1 - 2 / math.e)) < 0.02  # C(1) = 1 - 2/e
+    assert abs(np.mean(radii >= 2.1) - (1 + 2.1) * math.exp(-2.1)) < 0.02  # 1 - C(0.7 rmax), tail in the band
@@ -0,0 +1,71 @@
+"""density grid: adaptive radius and heatmap tile counts (in memory, no db)"""
+import time
+
+import density
+from density import DensityGrid, cell_of
+
+
+def _grid(points) -> DensityGrid:
+    grid = DensityGrid(enabled=True)
+    for latitude, longitude in points:
+        grid.move(None, None, latitude, longitude)
+    return grid
+
+
+def test_radius_dense_vs_sparse():
+    center = (51.5, -0.12)
+    dense = _grid([(51.5 + i * 0.001, -0.12 + j * 0.001) for i in range(-10, 10) for j in range(-10, 10)])
+    sparse = _grid([(51.5 + i * 0.01, -0.12 + j * 0.01) for i in range(-10, 10) for j in range(-10, 10)])
+
+    dense_radius = dense.effective_radius(*center, k=20, max_distance_km=50)
+    sparse_radius = sparse.effective_radius(*center, k=20, max_distance_km=50)
+    assert density.MIN_RADIUS_KM <= dense_radius < sparse_radius < 50
+
+
+def test_radius_bounds():
+    grid = _grid([(51.5, -0.12)] * 3)
+    assert grid.effective_radius(51.5, -0.12, k=20, max_distance_km=5) == 5  # too few users: upper bound
+    assert _grid([(51.5, -0.12)] * 10_000).effective_radius(51.5, -0.12, k=20, max_distance_km=5) == density.MIN_RADIUS_KM
+    assert DensityGrid(enabled=False).effective_radius(51.5, -0.12, k=20, max_distance_km=7) == 7
+
+
+def test_radius_rings_capped():
+    grid = _grid([(0.0, 0.0)])
+    t = time.perf_counter()
+    assert grid.effective_radius(0.0, 0.0, k=20, max_distance_km=20_000) == 20_000
+    assert time.perf_counter() - t < 0.5  # MAX_RINGS, not max_distance / cell size
+
+
+def test_radius_not_blocked_by_lock():
+    grid = _grid([(51.5 + i * 0.01, -0.12) for i in range(-30, 30)])
+    with grid._lock:  # a writer in progress, would deadlock if the ring loop took the lock
+        radius = grid.effective_radius(51.5, -0.12, k=20, max_distance_km=50)
+    assert density.MIN_RADIUS_KM < radius < 50
+
+
+def test_move_updates_cells():
+    grid = _grid([(51.5, -0.12)])
+    grid.move(51.5, -0.12, 48.85, 2.35)
+    assert grid.counts[cell_of(51.5, -0.12)] == 0
+    assert grid.counts[cell_of(48.85, 2.35)] == 1
+
+
+def test_tile_of():
+    assert density.tile_of(0.0, 0.0, 1) == (1, 1)
+    assert density.tile_of(51.5074, -0.1278, 10) == (511, 340)
+    assert density.tile_of(89.9, 180.0, 2) == (3, 0)  # clamped to the mercator range
+
+
+def test_tile_counts():
+    grid = _grid([(51.5074, -0.1278)] * 3 + [(48.8566, 2.3522)])
+    x, y = density.tile_of(51.5074, -0.1278, 10)
+    assert grid.tile_counts(10, x, y, detail=0) == [(x, y, 3)]
+    assert grid.tile_counts(0, 0, 0, detail=0) == [(0, 0, 4)]
+    assert grid.tile_counts(0, 0, 0, detail=1) == [(0, 0, 3), (1, 0, 1)]  # west / east of greenwich, empty left out
+
+    sub = grid.tile_counts(10, x, y, detail=8)  # capped at max zoom
+    assert sub == [(*density.tile_of(51.5074, -0.1278, grid.max_zoom), 3)]
+
+    grid.move(51.5074, -0.1278, 48.8566, 2.3522)
+    assert grid.tile_counts(10, x, y, detail=0) == [(x, y, 2)]
+    assert grid.tile_counts(0, 0, 0, detail=0) == [(0, 0, 4)]
@@ -0,0 +1,37 @@
+"""no-op location update suppression (in memory, no db)"""
+from datetime import datetime, timedelta, UTC
+
+from last_positions import LastPositions, WRITE, TOUCH, SKIP
+
+T0 = datetime(2026, 1, 1, tzinfo=UTC)
+
+
+def test_write_skip_touch():
+    positions = LastPositions(heartbeat_seconds=60, enabled=True)
+    assert positions.check("a", 51.5, -0.12, T0) == WRITE  # unknown
+    positions.written("a", 51.5, -0.12, T0)
+
+    assert positions.check("a", 51.5, -0.12, T0 + timedelta(seconds=59)) == SKIP
+    assert positions.check("a", 51.5, -0.12, T0 + timedelta(seconds=60)) == TOUCH
+    assert positions.check("a", 51.5001, -0.12, T0 + timedelta(seconds=1)) == WRITE  # moved
+    assert positions.stats() == {WRITE: 2, TOUCH: 1, SKIP: 1, "users": 1}
+
+
+def test_oldest_written_evicted():
+    positions = LastPositions(heartbeat_seconds=60, max_users=2, enabled=True)
+    positions.written("a", 1.0, 1.0, T0)
+    positions.written("b", 2.0, 2.0, T0)
+    positions.written("a", 1.0, 1.0, T0)  # rewritten: now the newest
+    positions.written("c", 3.0, 3.0, T0)
+
+    assert positions.check("b", 2.0, 2.0, T0) == WRITE
+    assert positions.check("a", 1.0, 1.0, T0) == SKIP
+    assert positions.check("c", 3.0, 3.0, T0) == SKIP
+    assert positions.stats()["users"] == 2
+
+
+def test_disabled_always_writes():
+    positions = LastPositions(heartbeat_seconds=60, enabled=False)
+    positions.written("a", 51.5, -0.12, T0)
+    assert positions.check("a", 51.5, -0.12, T0) == WRITE
+    assert positions.stats()["users"] == 0
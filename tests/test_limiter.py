@@ -0,0 +1,94 @@
+"""admission control: token buckets, rate keys, concurrency caps (small app, no db)"""
+import asyncio
+from typing import Annotated
+
+import pytest
+from fastapi import FastAPI, Form
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import limiter
+from limiter import AdmissionControl, TokenBucket
+
+LOGIN = ("POST", "/login_for_access_token")
+STREAM = ("GET", "/stream")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limiter.time, "monotonic", clock)
+    return clock
+
+
+def _app(admission: AdmissionControl) -> TestClient:
+    app = FastAPI()
+    app.middleware("http")(admission)
+
+    @app.post("/login_for_access_token")
+    def login(username: Annotated[str, Form()], password: Annotated[str, Form()]):
+        return {"username": username}
+
+    @app.get("/stream")
+    def stream():
+        async def lines():
+            for _ in range(3):
+                await asyncio.sleep(0)
+                yield f"{admission.in_flight[STREAM]}\n"  # the query runs here, lazily
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    return TestClient(app)
+
+
+def _login(client, username):
+    return client.post("/login_for_access_token", data={"username": username, "password": "x"})
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.take() == pytest.approx(0.5)
+    assert bucket.wait_time() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.take() == 0
+    clock.now += 100
+    assert bucket.is_full(clock.now) and bucket.tokens <= 3
+
+
+def test_login_keyed_by_username_and_ip(clock):
+    client = _app(AdmissionControl(rate_limits={LOGIN: (0.001, 2)}, concurrency_limits={}, enabled=True,
+                                   ip_rate_limits={LOGIN: (0.001, 5)}))
+    statuses = [(u, _login(client, u).status_code) for u in ["a", "a", "a", "b", "b", "c", "d"]]
+    # a: own bucket empty after 2. d: ip bucket empty after 5 allowed logins
+    assert statuses == [("a", 200), ("a", 200), ("a", 429), ("b", 200), ("b", 200), ("c", 200), ("d", 429)]
+    assert _login(client, "b").json()["detail"] == "Too many requests"
+
+
+def test_no_token_taken_when_rejected(clock):
+    admission = AdmissionControl(rate_limits={LOGIN: (0.001, 2)}, concurrency_limits={}, enabled=True,
+                                 ip_rate_limits={LOGIN: (1, 1)})
+    client = _app(admission)
+    assert _login(client, "a").status_code == 200
+    assert _login(client, "a").status_code == 429  # ip bucket empty
+    clock.now += 1  # ip bucket refilled: user bucket still has its second token
+    assert _login(client, "a").status_code == 200
+
+
+def test_streamed_body_counts_in_flight():
+    admission = AdmissionControl(rate_limits={}, concurrency_limits={STREAM: 1}, enabled=True)
+    client = _app(admission)
+    response = client.get("/stream")
+    assert response.text.split() == ["1", "1", "1"]
+    assert admission.in_flight[STREAM] == 0
+
+    admission.in_flight[STREAM] = 1  # another stream running
+    assert client.get("/stream").status_code == 429
+    assert admission.stats()["GET /stream"]["shed"] == 1
@@ -0,0 +1,72 @@
+"""buffered location writes: coalescing and failed flushes (flush_fn stands in for the upsert)"""
+from datetime import datetime, UTC
+
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import DataError, OperationalError
+
+import main
+from location_buffer import LocationWriteBuffer
+from sec import get_current_active_user, TokenUser
+
+NOW = datetime.now(UTC)
+
+
+class FakeDb:
+    def __init__(self):
+        self.rows = []
+        self.down = False
+        self.batches = 0
+
+    def write(self, rows):
+        self.batches += 1
+        if self.down:
+            raise OperationalError("upsert", {}, Exception("connection refused"))
+        if any(abs(row[1]) > 90 for row in rows):
+            raise DataError("upsert", {}, Exception("latitude out of range"))
+        self.rows.extend(rows)
+
+
+def test_coalesces_last_point_per_user():
+    db = FakeDb()
+    buffer = LocationWriteBuffer(db.write, enabled=True)
+    buffer.add(("a", 1.0, 1.0, NOW))
+    buffer.add(("b", 2.0, 2.0, NOW))
+    buffer.add(("a", 3.0, 3.0, NOW))
+    assert buffer.flush() == 2
+    assert sorted(db.rows) == [("a", 3.0, 3.0, NOW), ("b", 2.0, 2.0, NOW)]
+    assert db.batches == 1 and buffer.flush() == 0
+
+
+def test_requeued_while_db_down():
+    db = FakeDb()
+    buffer = LocationWriteBuffer(db.write, enabled=True)
+    buffer.add(("a", 1.0, 1.0, NOW))
+    buffer.add(("b", 2.0, 2.0, NOW))
+    db.down = True
+    assert buffer.flush() == 0
+    buffer.add(("a", 5.0, 5.0, NOW))  # newer point wins over the requeued one
+
+    db.down = False
+    assert buffer.flush() == 2
+    assert sorted(db.rows) == [("a", 5.0, 5.0, NOW), ("b", 2.0, 2.0, NOW)]
+    assert buffer.dropped == 0
+
+
+def test_bad_row_dropped_others_written():
+    db = FakeDb()
+    buffer = LocationWriteBuffer(db.write, enabled=True)
+    for row in [("a", 1.0, 1.0, NOW), ("bad", 95.0, 0.0, NOW), ("c", 3.0, 3.0, NOW)]:
+        buffer.add(row)
+    assert buffer.flush() == 2
+    assert sorted(row[0] for row in db.rows) == ["a", "c"]
+    assert buffer.dropped == 1
+    assert buffer.flush() == 0  # not requeued
+
+
+def test_out_of_range_location_rejected(monkeypatch):
+    monkeypatch.setitem(main.app.dependency_overrides, get_current_active_user, lambda: TokenUser("a"))
+    client = TestClient(main.app)
+    for latitude, longitude in [("91", "0"), ("0", "181"), ("-90.5", "0"), ("NaN", "0"), ("0", "Infinity")]:
+        body = f'{{"user_id": "a", "latitude": {latitude}, "longitude": {longitude}}}'  # NaN: not valid strict json
+        response = client.post("/locations", content=body, headers={"Content-Type": "application/json"})
+        assert response.status_code == 422, (latitude, longitude)
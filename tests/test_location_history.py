@@ -0,0 +1,71 @@
+"""location history writer: failed inserts (_insert stands in for the db)"""
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy.exc import DataError, OperationalError
+
+from location_history import LocationHistoryWriter, LOCATION_HISTORY_DAYS_AHEAD, LOCATION_HISTORY_RETENTION_DAYS
+
+NOW = datetime.now(UTC)
+
+
+class FakeDb:
+    def __init__(self):
+        self.rows = []
+        self.down = False
+        self.inserts = 0
+
+    def insert(self, rows):
+        self.inserts += 1
+        if self.down:
+            raise OperationalError("insert", {}, Exception("connection refused"))
+        if any(row[0].startswith("bad") for row in rows):
+            raise DataError("insert", {}, Exception("invalid row"))
+        self.rows.extend(rows)
+
+
+def _writer(db: FakeDb, **kwargs) -> LocationHistoryWriter:
+    writer = LocationHistoryWriter(enabled=True, **kwargs)
+    writer._insert = db.insert
+    return writer
+
+
+def _row(user_id, at=NOW):
+    return user_id, 51.5, -0.12, at
+
+
+def test_bad_rows_split_out():
+    db = FakeDb()
+    writer = _writer(db)
+    for i in range(64):
+        writer.add(_row(f"bad{i}" if i in (5, 40) else f"u{i}"))
+    assert writer.flush() == 62
+    assert [row[0] for row in db.rows] == [f"u{i}" for i in range(64) if i not in (5, 40)]  # time order kept
+    assert writer.dropped == 2
+    assert db.inserts < 64  # halves, not row by row
+    assert writer.flush() == 0
+
+
+def test_put_back_while_db_down():
+    db = FakeDb()
+    writer = _writer(db, max_pending=3)
+    for i in range(3):
+        writer.add(_row(f"u{i}"))
+    db.down = True
+    assert writer.flush() == 0
+    writer.add(_row("late"))  # queue full
+    assert writer.dropped == 1
+
+    db.down = False
+    assert writer.flush() == 3
+    assert [row[0] for row in db.rows] == ["u0", "u1", "u2"]
+
+
+def test_rows_outside_partitions_dropped():
+    db = FakeDb()
+    writer = _writer(db)
+    writer.add(_row("old", NOW - timedelta(days=LOCATION_HISTORY_RETENTION_DAYS + 1)))
+    writer.add(_row("now"))
+    writer.add(_row("future", NOW + timedelta(days=LOCATION_HISTORY_DAYS_AHEAD + 1)))
+    assert writer.flush() == 1
+    assert [row[0] for row in db.rows] == ["now"]
+    assert writer.dropped == 2
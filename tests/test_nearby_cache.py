@@ -0,0 +1,36 @@
+"""nearby cache: refresh batch sizing, which requests the cache answers (cache lookups stubbed, no db)"""
+from fastapi.testclient import TestClient
+
+import main
+from nearby_cache import NearbyCache, REFRESH_BATCH_SIZE
+from sec import get_current_active_user, TokenUser
+
+
+def test_stale_batch_scales_with_rows():
+    cache = NearbyCache(k=20, max_age_seconds=60)
+    assert cache.stale_batch_size(0) == REFRESH_BATCH_SIZE
+    # 2 s ticks, every row within 30 s: 15 ticks
+    assert cache.stale_batch_size(150_000) == 10_000
+    assert cache.stale_batch_size(150_000) * 30 / 2 >= 150_000
+
+
+def test_cache_only_for_exact_requests(monkeypatch):
+    calls = []
+
+    def get(user_id, max_distance):
+        calls.append((user_id, max_distance))
+        return [{"user_id": "b", "distance_km": 1.0, "latitude": 51.5, "longitude": -0.1}]
+
+    monkeypatch.setattr(main.nearby_cache, "get", get)
+    monkeypatch.setitem(main.app.dependency_overrides, get_current_active_user, lambda: TokenUser("a"))
+    monkeypatch.setattr(main.admission_control, "enabled", False)
+    monkeypatch.setattr(main.cell_versions, "enabled", False)
+    client = TestClient(main.app, raise_server_exceptions=False)
+
+    response = client.get("/locations/nearby_users", params={"user_id": "a"})
+    assert response.status_code == 200 and response.json()[0]["user_id"] == "b"
+    assert calls == [("a", 5.0)]
+
+    for params in [{"adaptive": True}, {"precision": "fast"}, {"precision": "sphere"}]:
+        client.get("/locations/nearby_users", params={"user_id": "a", **params})  # live query (no db here)
+    assert len(calls) == 1
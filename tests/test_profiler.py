@@ -0,0 +1,60 @@
+"""request profiler: who can force a profile, file rotation, stack names (small app, no db)"""
+import os
+import sys
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import sec
+from profiler import RequestProfiler, _frame_name, _stack
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(sec, "SERVICE_TOKEN", "service-secret")
+    profiler = RequestProfiler(sample_rate=0, routes=[], out_dir=str(tmp_path), enabled=True, max_files=2)
+    yield profiler
+    profiler.stop()
+
+
+def _client(profiler: RequestProfiler) -> TestClient:
+    app = FastAPI()
+    app.middleware("http")(profiler)
+
+    @app.get("/ping")
+    def ping():
+        return {}
+
+    return TestClient(app)
+
+
+def test_header_needs_service_token(profiler):
+    client = _client(profiler)
+    assert "X-Profile-Samples" not in client.get("/ping", headers={"X-Profile": "1"}).headers
+    assert "X-Profile-Samples" not in client.get("/ping", headers={"X-Profile": "wrong"}).headers
+    assert "X-Profile-Samples" in client.get("/ping", headers={"X-Profile": "service-secret"}).headers
+
+
+def test_header_ignored_without_service_token(profiler, monkeypatch):
+    monkeypatch.setattr(sec, "SERVICE_TOKEN", None)
+    assert "X-Profile-Samples" not in _client(profiler).get("/ping", headers={"X-Profile": ""}).headers
+
+
+def test_oldest_files_deleted(profiler, tmp_path):
+    (tmp_path / "20000101T000000.000000_GET_old_200_1ms.folded").write_text("")
+    client = _client(profiler)
+    for _ in range(3):
+        client.get("/ping", headers={"X-Profile": "service-secret"})
+    profiler._write_finished()
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == 2 and not files[0].startswith("2000")
+    assert profiler.profiled == 3
+
+
+def test_frame_names():
+    frame = sys._getframe()
+    assert _frame_name(frame) == f"{__name__}:test_frame_names"
+    assert _frame_name(frame, lines=True) == f"{__name__}:test_frame_names:{frame.f_lineno}"
+    assert _stack(frame, "main").startswith("main;")
+    assert _stack(frame, "main").endswith(f";{__name__}:test_frame_names")
@@ -0,0 +1,219 @@
+"""
+psi routes over the app with auth overridden (no db). run from the repo root: python -m pytest
+"""
+import base64
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import psi
+from sec import get_current_active_user, TokenUser
+
+INITIATOR, JOINER = "alice", "bob"
+
+
+@pytest.fixture
+def as_user(monkeypatch):
+    """as_user(user_id): requests from now on are authenticated as user_id"""
+    current = {"user_id": INITIATOR}
+    monkeypatch.setitem(main.app.dependency_overrides, get_current_active_user,
+                        lambda: TokenUser(current["user_id"]))
+    monkeypatch.setattr(main.admission_control, "enabled", False)
+    monkeypatch.setattr(psi, "session_manager", psi.SessionManager())
+    monkeypatch.setattr(psi, "upload_manager", psi.UploadManager())
+    return lambda user_id: current.update(user_id=user_id)
+
+
+@pytest.fixture
+def client(as_user):
+    with TestClient(main.app) as client:  # one event loop for all requests (long poll wake ups)
+        yield client
+
+
+def _init(client, values) -> str:
+    response = client.post("/psi/init", json={"blinded_values": values, "user_id": INITIATOR})
+    assert response.status_code == 201
+    return response.json()["session_id"]
+
+
+def _open(client, size, **params) -> str:
+    response = client.post("/psi/uploads", json={"size": size, **params})
+    assert response.status_code == 201
+    return response.json()["upload_id"]
+
+
+def _append(client, upload_id, offset, data):
+    return client.patch(f"/psi/uploads/{upload_id}", params={"offset": offset}, content=data)
+
+
+def test_digest_join(client, as_user):
+    session_id = _init(client, [1, 2, 3])
+    as_user(JOINER)
+    join = {"session_id": session_id, "response_values": [7], "user_id": JOINER, "digest_bits": 32}
+
+    digests = base64.b64encode(bytes(range(8))).decode()  # 2 of 3 digests
+    assert client.post(f"/psi/{session_id}/join", json={**join, "response_digests": digests}).status_code == 400
+    assert client.post(f"/psi/{session_id}/join",
+                       json={**join, "digest_bits": 33, "response_digests": digests}).status_code == 400
+
+    digests = base64.b64encode(bytes(range(12))).decode()
+    assert client.post(f"/psi/{session_id}/join", json={**join, "response_digests": digests}).status_code == 200
+
+    as_user(INITIATOR)
+    body = client.get(f"/psi/{session_id}").json()
+    assert body["digests"] == {JOINER: {"bits": 32, "data": digests}}
+
+
+def test_chunked_init_upload(client):
+    payload = psi.pack_values([4, 6, 8])
+    upload_id = _open(client, len(payload), purpose="init")
+
+    assert _append(client, upload_id, 0, payload[:300]).json() == {"offset": 300, "size": len(payload)}
+    assert _append(client, upload_id, 0, payload[:300]).status_code == 409  # offset mismatch
+    assert client.post(f"/psi/uploads/{upload_id}/seal").status_code == 400  # incomplete
+
+    # resume from the server's offset
+    offset = client.get(f"/psi/uploads/{upload_id}").json()["offset"]
+    assert _append(client, upload_id, offset, payload[offset:]).json()["offset"] == len(payload)
+    assert _append(client, upload_id, len(payload), b"x").status_code == 413  # beyond declared size
+
+    response = client.post(f"/psi/uploads/{upload_id}/seal")
+    assert response.status_code == 201
+    session_id = response.json()["session_id"]
+    assert client.get(f"/psi/{session_id}").json()["values"] == [4, 6, 8]
+    assert client.get(f"/psi/uploads/{upload_id}").status_code == 404  # consumed by the seal
+
+
+def test_chunked_join_upload(client, as_user):
+    session_id = _init(client, [1, 2])
+    as_user(JOINER)
+    payload = psi.pack_values([9]) + bytes(range(8))  # values, then 2 digests of 32 bits
+
+    upload_id = _open(client, len(payload), purpose="join", session_id="missing", digest_bits=32)
+    _append(client, upload_id, 0, payload)
+    assert client.post(f"/psi/uploads/{upload_id}/seal").status_code == 404
+    assert client.get(f"/psi/uploads/{upload_id}").status_code == 200  # kept after a rejected seal
+
+    upload_id = _open(client, len(payload), purpose="join", session_id=session_id, digest_bits=32)
+    _append(client, upload_id, 0, payload)
+    assert client.post(f"/psi/uploads/{upload_id}/seal").json() == {"status": 2, "session_id": session_id}
+
+    as_user(INITIATOR)
+    body = client.get(f"/psi/{session_id}").json()
+    assert body["values"] == {JOINER: [9]}
+    assert base64.b64decode(body["digests"][JOINER]["data"]) == bytes(range(8))
+
+
+def test_upload_busy_and_expired(client):
+    upload_id = _open(client, 512, purpose="init")
+
+    psi.upload_manager.uploads[upload_id].appending = True  # another PATCH is streaming
+    assert _append(client, upload_id, 0, b"x").status_code == 409
+    assert client.post(f"/psi/uploads/{upload_id}/seal").status_code == 409
+
+    psi.upload_manager.uploads[upload_id].created_at = (
+        datetime.now(UTC) - timedelta(minutes=psi.SESSION_TIMEOUT_MINUTES + 1))
+    assert client.get(f"/psi/uploads/{upload_id}").status_code == 410
+    assert client.get(f"/psi/uploads/{upload_id}").status_code == 404
+
+
+def test_upload_caps(client, as_user, monkeypatch):
+    monkeypatch.setattr(psi, "upload_manager", psi.UploadManager(max_per_user=2, max_bytes=3 * 512))
+    first = _open(client, 512, purpose="init")
+    _open(client, 512, purpose="init")
+    assert client.post("/psi/uploads", json={"purpose": "init", "size": 512}).status_code == 429  # per user
+
+    as_user(JOINER)
+    assert client.post("/psi/uploads", json={"purpose": "init", "size": 1024}).status_code == 413  # total bytes
+    _open(client, 512, purpose="init")
+
+    as_user(INITIATOR)
+    _append(client, first, 0, b"\1" * 512)
+    assert client.post(f"/psi/uploads/{first}/seal").status_code == 201  # frees its slot and bytes
+    assert psi.upload_manager.reserved_bytes == 2 * 512
+    _open(client, 512, purpose="init")
+
+
+def test_sweep_expired(client):
+    session_id = _init(client, [1])
+    upload_id = _open(client, 512, purpose="init")
+    expired = datetime.now(UTC) - timedelta(minutes=psi.SESSION_TIMEOUT_MINUTES + 1)
+    psi.session_manager.sessions[session_id].created_at = expired
+    psi.upload_manager.uploads[upload_id].created_at = expired
+    _init(client, [2])
+
+    assert psi.session_manager.cleanup_expired_sessions() == 1
+    assert psi.upload_manager.cleanup_expired() == 1
+    assert session_id not in psi.session_manager.sessions and len(psi.session_manager.sessions) == 1
+    assert psi.upload_manager.reserved_bytes == 0 and not psi.upload_manager.per_user
+
+
+def test_join_and_values(client, as_user):
+    session_id = _init(client, [3, 5, 2 ** 2047])
+    assert client.get(f"/psi/{session_id}").json() == {"values": [3, 5, 2 ** 2047], "status": 1}
+
+    as_user(JOINER)
+    response = client.post(f"/psi/{session_id}/join",
+                           json={"session_id": session_id, "response_values": [7, 11], "user_id": JOINER})
+    assert response.json() == {"status": 2, "session_id": session_id}
+    assert client.get(f"/psi/{session_id}").status_code == 403
+
+    as_user(INITIATOR)
+    body = client.get(f"/psi/{session_id}").json()
+    assert body["values"] == {JOINER: [7, 11]} and body["digests"] == {} and body["status"] == 2
+
+
+def test_b64_range(client):
+    values = list(range(1, 11))
+    session_id = _init(client, values)
+
+    body = client.get(f"/psi/{session_id}", params={"encoding": "b64", "offset": 2, "limit": 3}).json()
+    assert body["status"] == 1
+    assert psi.unpack_values(base64.b64decode(body["values"])) == values[2:5]
+
+    body = client.get(f"/psi/{session_id}", params={"encoding": "b64", "offset": 8}).json()
+    assert psi.unpack_values(base64.b64decode(body["values"])) == values[8:]
+
+    assert client.get(f"/psi/{session_id}", params={"encoding": "b64", "limit": 0}).status_code == 422
+
+
+def test_wait_wakes_up(client, as_user):
+    session_id = _init(client, [1])
+    results = {}
+
+    def wait():
+        t = time.monotonic()
+        results["joined"] = client.get(f"/psi/{session_id}/wait", params={"until": "joined", "timeout": 10}).json()
+        results["seconds"] = time.monotonic() - t
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.3)
+    as_user(JOINER)  # the waiter's request is already authenticated
+    client.post(f"/psi/{session_id}/join", json={"session_id": session_id, "response_values": [2], "user_id": JOINER})
+    waiter.join(5)
+
+    assert results["joined"] == {"status": 2, "ready": True}
+    assert results["seconds"] < 5
+
+
+def test_wait_access(client, as_user):
+    session_id = _init(client, [1])
+    assert client.get(f"/psi/{session_id}/wait",
+                      params={"until": "joined", "timeout": 0.1}).json() == {"status": 1, "ready": False}
+
+    as_user(JOINER)
+    assert client.get(f"/psi/{session_id}/wait", params={"until": "joined", "timeout": 0.1}).status_code == 403
+    assert client.get(f"/psi/{session_id}/wait", params={"until": "intersection", "timeout": 0.1}).status_code == 403
+    client.post(f"/psi/{session_id}/join", json={"session_id": session_id, "response_values": [2], "user_id": JOINER})
+
+    as_user(INITIATOR)
+    client.patch(f"/psi/{session_id}/intersection",
+                 json={"user_id": INITIATOR, "other_user_id": JOINER, "len_intersection": 1})
+    as_user(JOINER)
+    body = client.get(f"/psi/{session_id}/wait", params={"until": "intersection", "timeout": 0.1}).json()
+    assert body == {"status": 3, "ready": True, "intersection_len": 1}
@@ -0,0 +1,27 @@
+"""token revocation list: in-memory checks (no db)"""
+from datetime import datetime, UTC
+
+from revocation import RevocationList
+
+CUTOFF = datetime(2026, 1, 1, tzinfo=UTC)
+
+
+def test_tokens_valid_after():
+    revocation = RevocationList()
+    assert not revocation.is_revoked("a", CUTOFF.timestamp() - 1)  # not listed
+
+    revocation.update("a", disabled=False, tokens_valid_after=CUTOFF)
+    assert revocation.is_revoked("a", CUTOFF.timestamp() - 1)
+    assert not revocation.is_revoked("a", CUTOFF.timestamp())
+    assert revocation.is_revoked("a", None)  # no iat: issued before any cutoff
+    assert not revocation.is_revoked("b", None)
+
+
+def test_disabled_and_reenabled():
+    revocation = RevocationList()
+    revocation.update("a", disabled=True, tokens_valid_after=None)
+    assert revocation.is_revoked("a", datetime.now(UTC).timestamp() + 3600)  # any token
+
+    revocation.update("a", disabled=False, tokens_valid_after=None)
+    assert "a" not in revocation.revoked
+    assert not revocation.is_revoked("a", None)